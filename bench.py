@@ -0,0 +1,217 @@
+#!/usr/bin/env python2
+# -*- coding: euc-jp -*-
+#
+# bench.py - throughput/latency benchmark for tenjer.py
+#
+#   usage: python bench.py [-m|-t] [-n lines] [-o result.json] [-b baseline.json]
+#          python bench.py -I budget_ms
+#
+
+import sys, os, time, random, json, subprocess
+import tenjer
+
+
+##  corpora
+##
+##  Synthetic corpora are generated from the dictionary itself
+##  so that the benchmark needs no external text.
+##
+PARTICLES = [u'', u'', u'', u'', u'', u'',
+             u'', u'', u'', u'', u'ޤ']
+ENDINGS = [u'', u'', u'Ǥ', u'ޤ']
+LATIN = [u'Python', u'TCDB', u'NABCC', u'ABC-123', u'x86_64', u'v2.7', u'UTF-8']
+
+def load_words(tcdb):
+    words = []
+    path = {0: u''}
+    for (parent, pos, k, v) in tcdb.iterrecords():
+        w = path[parent]+k.decode(tcdb.codec, 'ignore')
+        path[pos] = w
+        if v:
+            words.append((w, tenjer.decode_yomi(v)))
+    return words
+
+def kata2hira(s):
+    return u''.join( unichr(ord(c)-96) if u'\u30a1' <= c <= u'\u30f3' else c for c in s )
+
+def make_corpora(words, nlines, seed=0):
+    rand = random.Random(seed)
+    kanji = [ w for (w,_) in words if all( u'\u4e00' <= c <= u'\u9fff' for c in w ) ]
+    def sentence(pick, n):
+        return u''.join( pick()+rand.choice(PARTICLES) for _ in xrange(n) )+rand.choice(ENDINGS)
+    corpora = {}
+    corpora['kanji'] = [ sentence(lambda: rand.choice(kanji), rand.randint(3, 8))
+                         for _ in xrange(nlines) ]
+    corpora['kana'] = [ sentence(lambda: kata2hira(rand.choice(words)[1]), rand.randint(3, 8))
+                        for _ in xrange(nlines) ]
+    corpora['mixed'] = [ sentence(lambda: rand.choice([rand.choice(LATIN),
+                                                       str(rand.randint(0, 99999)),
+                                                       rand.choice(kanji)]),
+                                  rand.randint(3, 8))
+                         for _ in xrange(nlines) ]
+    corpora['long'] = [ u''.join( rand.choice(corpora[k]) for _ in xrange(100)
+                                  for k in ('kanji', 'kana', 'mixed') )
+                        for _ in xrange(max(1, nlines/100)) ]
+    return corpora
+
+
+##  CountingTCDB
+##
+class CountingTCDB(tenjer.TrieLookup):
+
+    def __init__(self, tcdb):
+        self.tcdb = tcdb
+        self.lookups = 0
+        return
+
+    def find1(self, k, parent=0L):
+        self.lookups += 1
+        return self.tcdb.find1(k, parent)
+
+
+##  benchmark
+##
+def percentile(a, p):
+    a = sorted(a)
+    return a[min(len(a)-1, int(len(a)*p))]
+
+def timeit(func, args):
+    t0 = time.time()
+    for x in args:
+        func(x)
+    return time.time()-t0
+
+def bench_corpus(tcdb, lines):
+    nchars = sum( len(line) for line in lines )
+    translator = tenjer.Translator(tcdb)
+    wakacher = translator.wakacher
+    yomer = translator.yomer
+    tenjer_ = translator.tenjer
+    chunks = [ s for line in lines for s in wakacher.get_chunks(line) ]
+    yomis = [ u''.join( v or k for (k,v) in y ) for s in chunks for y in yomer.get_yomi(s) ]
+    words = [ [ b for (_,b) in translator.translate_chunk(s) ] for s in chunks ]
+    result = {}
+    for (name, func, args) in (
+        ('wakacher', wakacher.get_chunks, lines),
+        ('yomer', yomer.get_yomi, chunks),
+        ('tenjer', tenjer_.get_brl, yomis),
+        ('fold', lambda w: list(tenjer.fold(w)), words),
+        ):
+        dt = timeit(func, args)
+        result[name] = {'secs': dt, 'chars_per_sec': nchars/max(dt, 1e-9)}
+    latencies = []
+    t0 = time.time()
+    for line in lines:
+        t1 = time.time()
+        translator.translate(line)
+        latencies.append(time.time()-t1)
+    dt = time.time()-t0
+    counter = CountingTCDB(tcdb)
+    counted = tenjer.Translator(counter)
+    for line in lines:
+        counted.translate(line)
+    result['total'] = {
+        'secs': dt,
+        'chars_per_sec': nchars/max(dt, 1e-9),
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p90': percentile(latencies, 0.90),
+        'latency_p99': percentile(latencies, 0.99),
+        'lookups_per_char': counter.lookups/float(max(1, nchars)),
+        }
+    result['lines'] = len(lines)
+    result['chars'] = nchars
+    return result
+
+# measures the import time of tenjer in fresh interpreters.
+# The fastest of the runs is taken, so that a stale .pyc or
+# a busy machine does not count against the budget.
+IMPORT_SCRIPT = 'import time; t0 = time.time(); import tenjer; print time.time()-t0'
+def bench_import(runs=10):
+    cwd = os.path.dirname(os.path.abspath(tenjer.__file__))
+    return min( float(subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], cwd=cwd))
+                for _ in xrange(runs) )
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for (corpus, r) in sorted(results.iteritems()):
+        if corpus not in baseline: continue
+        for (stage, x) in sorted(r.iteritems()):
+            if not isinstance(x, dict): continue
+            b = baseline[corpus].get(stage)
+            if not b: continue
+            ratio = x['chars_per_sec']/b['chars_per_sec']
+            flag = ''
+            if ratio < 1.0-threshold:
+                flag = ' REGRESSION'
+                regressions.append((corpus, stage))
+            print '%-6s %-9s %6.2fx%s' % (corpus, stage, ratio, flag)
+    return regressions
+
+# main
+def main(argv):
+    import getopt
+    def usage():
+        print ('usage: %s [-m|-t] [-n lines] [-s seed] [-o result.json]'
+               ' [-b baseline.json] [-T threshold] [-D dictpath]' % argv[0])
+        print 'usage: %s -I budget_ms' % argv[0]
+        return 100
+    try:
+        (opts, args) = getopt.getopt(argv[1:], 'mtn:s:o:b:T:D:I:')
+    except getopt.GetoptError:
+        return usage()
+    reader = tenjer.TCDBReader
+    nlines = 1000
+    seed = 0
+    output = None
+    baseline = None
+    threshold = 0.1
+    dictpath = 'tenjer.tcdb'
+    budget = None
+    for (k, v) in opts:
+        if k == '-m': reader = tenjer.MmapTCDBReader
+        elif k == '-t': reader = tenjer.TCDBTrie
+        elif k == '-n': nlines = int(v)
+        elif k == '-s': seed = int(v)
+        elif k == '-o': output = v
+        elif k == '-b': baseline = v
+        elif k == '-T': threshold = float(v)
+        elif k == '-D': dictpath = v
+        elif k == '-I': budget = float(v)
+    if budget is not None:
+        secs = bench_import()
+        flag = ''
+        if budget < secs*1000:
+            flag = ' OVER BUDGET (%.1fms)' % budget
+        print 'import %8.1fms%s' % (secs*1000, flag)
+        if flag:
+            return 1
+        return 0
+    words = load_words(tenjer.TCDBReader(dictpath, 'euc-jp'))
+    corpora = make_corpora(words, nlines, seed=seed)
+    tcdb = reader(dictpath, 'euc-jp')
+    results = {}
+    for (name, lines) in sorted(corpora.iteritems()):
+        r = bench_corpus(tcdb, lines)
+        results[name] = r
+        t = r['total']
+        print ('%-6s %8d chars/sec  p50=%.3fms p90=%.3fms p99=%.3fms  %.2f lookups/char' %
+               (name, t['chars_per_sec'], t['latency_p50']*1000, t['latency_p90']*1000,
+                t['latency_p99']*1000, t['lookups_per_char']))
+        for stage in ('wakacher', 'yomer', 'tenjer', 'fold'):
+            print '  %-9s %10d chars/sec' % (stage, r[stage]['chars_per_sec'])
+    secs = bench_import()
+    results['import'] = {'secs': secs}
+    print 'import %8.1fms' % (secs*1000)
+    if output is not None:
+        fp = open(output, 'w')
+        json.dump(results, fp, indent=1, sort_keys=True)
+        fp.close()
+    if baseline is not None:
+        fp = open(baseline)
+        regressions = compare(results, json.load(fp), threshold)
+        fp.close()
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
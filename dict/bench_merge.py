@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+#
+# bench_merge.py - scaling of pycdb.cdbmerge
+#
+#   usage: python bench_merge.py [-k 2,8,32] [-n 1000,10000] [-s]
+#
+
+import sys, os, time, random, shutil, tempfile
+from pycdb import CDBMaker, cdbdump, cdbmerge, extsort
+
+
+# listmerge: the former cdbmerge (sort and pop(0) per item), for reference.
+def listmerge(iters):
+  q = []
+  for it in iters:
+    try:
+      q.append((it.next(),it))
+    except StopIteration:
+      pass
+  k0 = None
+  vs = None
+  while q:
+    q.sort()
+    ((k,v),it) = q.pop(0)
+    if k0 != k:
+      if vs: yield (k0,vs)
+      vs = []
+    vs.append(v)
+    k0 = k
+    try:
+      q.append((it.next(),it))
+    except StopIteration:
+      continue
+  if vs: yield (k0,vs)
+  return
+
+# make_dbs: k databases of n random keys each.
+def make_dbs(tmpdir, k, n, sort=True, seed=0):
+  rand = random.Random(seed)
+  names = []
+  for i in xrange(k):
+    name = os.path.join(tmpdir, 'db%d.cdb' % i)
+    keys = set( '%08d' % rand.randrange(n*k*4) for _ in xrange(n) )
+    keys = sorted(keys) if sort else list(keys)
+    m = CDBMaker(name, name+'.tmp')
+    for key in keys:
+      m.add(key, 'v%d' % i)
+    m.finish()
+    names.append(name)
+  return names
+
+def timeit(merge, names, sort):
+  t0 = time.time()
+  dbs = [ cdbdump(name) for name in names ]
+  if sort:
+    dbs = [ extsort(db, 10000) for db in dbs ]
+  n = 0
+  for _ in merge(dbs):
+    n += 1
+  return (n, time.time()-t0)
+
+# main
+def main(argv):
+  import getopt
+  def usage():
+    print 'usage: %s [-k 2,8,32] [-n 1000,10000] [-s]' % argv[0]
+    return 100
+  try:
+    (opts, args) = getopt.getopt(argv[1:], 'k:n:s')
+  except getopt.GetoptError:
+    return usage()
+  ks = [2, 8, 32]
+  ns = [1000, 10000]
+  sort = False
+  for (k, v) in opts:
+    if k == '-k': ks = map(int, v.split(','))
+    elif k == '-n': ns = map(int, v.split(','))
+    elif k == '-s': sort = True
+  tmpdir = tempfile.mkdtemp()
+  try:
+    print '%4s %8s %10s %12s %12s' % ('k', 'n', 'keys', 'heap(sec)', 'list(sec)')
+    for n in ns:
+      for k in ks:
+        names = make_dbs(tmpdir, k, n, sort=not sort)
+        (nkeys, dt) = timeit(cdbmerge, names, sort)
+        (_, dt0) = timeit(listmerge, names, sort)
+        print '%4d %8d %10d %12.3f %12.3f' % (k, n, nkeys, dt, dt0)
+  finally:
+    shutil.rmtree(tmpdir)
+  return 0
+
+if __name__ == '__main__': sys.exit(main(sys.argv))
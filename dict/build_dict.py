@@ -1,20 +1,17 @@
 #!/usr/bin/env python2
 # -*- coding: euc-jp -*-
-import sys
+import sys, os.path, time
 stdout = sys.stdout
 stderr = sys.stderr
 
 
 # encode the yomigana.
+YOMI = dict( (n, n-0x3000) for n in range(0x30a1, 0x30f5)+[0x30fc] )
 def encode_yomi(s):
-  def f(n):
-    if (0x30a1 <= n and n <= 0x30f4) or n == 0x30fc:
-      return chr(n-0x3000)
-    raise ValueError(n)
-  try:
-    return ''.join( f(ord(c)) for c in s )
-  except ValueError:
-    raise ValueError(repr(s))
+  for c in s:
+    if ord(c) not in YOMI:
+      raise ValueError(repr(s))
+  return s.translate(YOMI).encode('latin-1')
 
 CAN_TRANS = {
   u'': u'',
@@ -26,19 +23,15 @@ CAN_TRANS = {
 
 ##  build_dict
 ##
-def build_dict(output, files, codec):
+def build_dict(output, files, codec, nprocs=1):
   import fileinput
   from pycdb import tcdbmake
 
   # find the length of the common prefix of s1 and s2.
   def common_prefix(s1, s2):
-    s = zip(s1, s2)
-    for (i,(c1,c2)) in enumerate(s):
-      if c1 != c2: break
-    else:
-      i = len(s)
-    return i
+    return len(os.path.commonprefix([s1, s2]))
 
+  t0 = time.time()
   maker = tcdbmake(output, output+'.tmp')
   w0 = ''
   stderr.write('Writing %r...' % output)
@@ -58,8 +51,9 @@ def build_dict(output, files, codec):
     y = y.translate(CAN_TRANS)
     maker.put(i, w[-1].encode(codec), encode_yomi(y))
     w0 = w
-  maker.finish()
-  stderr.write('finished.\n')
+  maker.finish(nprocs)
+  stderr.write('finished: %d entries, %d bytes, %.2f sec.\n' %
+               (len(maker), os.path.getsize(output), time.time()-t0))
   return
 
 
@@ -67,19 +61,21 @@ def build_dict(output, files, codec):
 def main(argv):
   import getopt
   def usage():
-    print 'usage: %s [-o output] [-c codec] [file ...]' % argv[0]
+    print 'usage: %s [-o output] [-c codec] [-j nprocs] [file ...]' % argv[0]
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], 'o:c:')
+    (opts, args) = getopt.getopt(argv[1:], 'o:c:j:')
   except getopt.GetoptError:
     return usage()
   output = None
   codec = 'euc-jp'
+  nprocs = 1
   for (k, v) in opts:
     if k == '-o': output = v
     elif k == '-c': codec = v
+    elif k == '-j': nprocs = int(v)
   if output is None:
     return usage()
-  return build_dict(output, args, codec=codec)
+  return build_dict(output, args, codec=codec, nprocs=nprocs)
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
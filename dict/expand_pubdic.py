@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 # -*- coding: euc-jp -*-
-import sys
+import sys, os, re
 stdout = sys.stdout
 stderr = sys.stderr
 
@@ -9,26 +9,39 @@ HIRA2KATA = dict( (unichr(c),unichr(c+96)) for c in xrange(0x3041,0x3094) )
 def tokata(s): return ''.join( HIRA2KATA.get(c,c) for c in s )
 
 
+##  expand1
+##
+VALID_WORD = re.compile(ur'^[\u4e00-\u9fff][\u3041-\u309f\u4e00-\u9fff]*$')
+RMSP = re.compile(r'\s+')
+POS_EXPAND = {
+  u'Ը': u'',
+  u'Ը': u'',
+  u'Ը': u'',
+  u'Ը': u'ȤĤƤȤ',
+  u'ʹԸ': u'ʤˤ̤ͤΤ',
+  u'޹Ը': u'ޤߤ',
+  u'Ը': u'',
+  u'Ը': u'襤',
+  u'йԸ': u'ФӤ֤٤ܤ',
+  u'ƻ': u'',
+  }
+
+# returns [(pos1, [(word, yomi), ...]), ...] for a line.
+# raises ValueError if the line is malformed.
+def expand1(line):
+  f = RMSP.sub(' ', line).split(' ')
+  if len(f) != 4: raise ValueError(line)
+  (yomi,exp,poss,_) = f
+  if not VALID_WORD.match(exp) and poss != '-': return []
+  return [ (pos1, [ (exp+c, tokata(yomi+c)) for c in POS_EXPAND.get(pos1, ['']) ])
+           for pos1 in poss.split('&') ]
+
+
 ##  expand_pubdic
 ##
 def expand_pubdic(args, encoding='euc-jp', verbose=0):
-  import re, fileinput
+  import fileinput
   
-  VALID_WORD = re.compile(ur'^[\u4e00-\u9fff][\u3041-\u309f\u4e00-\u9fff]*$')
-  RMSP = re.compile(r'\s+')
-  POS_EXPAND = {
-    u'Ը': u'',
-    u'Ը': u'',
-    u'Ը': u'',
-    u'Ը': u'ȤĤƤȤ',
-    u'ʹԸ': u'ʤˤ̤ͤΤ',
-    u'޹Ը': u'ޤߤ',
-    u'Ը': u'',
-    u'Ը': u'襤',
-    u'йԸ': u'ФӤ֤٤ܤ',
-    u'ƻ': u'',
-    }
-
   dic = {}
   pos_freq = {}
   
@@ -44,22 +57,17 @@ def expand_pubdic(args, encoding='euc-jp', verbose=0):
       continue
     if not line: continue
     
-    f = RMSP.sub(' ', line).split(' ')
-    if len(f) == 4:
-      (yomi,exp,poss,_) = f
-    else:
+    try:
+      r = expand1(line)
+    except ValueError:
       print >>stderr, 'FormatError: filename=%r, lineno=%d: %r' % \
             (fp.filename(), fp.filelineno(), line)
       continue
 
-    if not VALID_WORD.match(exp) and poss != '-': continue
-    for pos1 in poss.split('&'):
-      r = POS_EXPAND.get(pos1, [''])
-      for c in r:
-        w = exp+c
+    for (pos1, words) in r:
+      for (w,y) in words:
         if w not in dic:
           dic[w] = []
-        y = tokata(yomi+c)
         d = dic[w]
         if y not in d:
           d.append(y)
@@ -76,16 +84,149 @@ def expand_pubdic(args, encoding='euc-jp', verbose=0):
   return
 
 
+##  expand_pubdic_sorted
+##
+##  Same output as expand_pubdic, with bounded memory: each file is
+##  parsed by a worker process that spills sorted runs of at most
+##  runsize words to temporary files, and the runs are merged
+##  (by pycdb.mergeruns, a limited number of files at a time).
+##  Runs are numbered in reading order, so that the readings of a word
+##  keep the order of their first appearance.
+##
+
+# spill: writes a sorted run of (word, runno, yomis) as UTF-8 lines
+# "word yomi ...".
+def spill(items, tmpdir):
+  import tempfile
+  (fd, path) = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+  fp = os.fdopen(fd, 'wb')
+  for (w,_,ys) in items:
+    fp.write((u'%s %s\n' % (w, ' '.join(ys))).encode('utf-8'))
+  fp.close()
+  return path
+
+# iterrun: reads a run back.
+def iterrun(path, runno):
+  fp = file(path, 'rb')
+  try:
+    for line in fp:
+      f = line.decode('utf-8').rstrip('\n').split(' ')
+      yield (f[0], runno, f[1:])
+  finally:
+    fp.close()
+  return
+
+def spilldic(dic, tmpdir):
+  return spill(( (w,0,dic[w]) for w in sorted(dic.iterkeys()) ), tmpdir)
+
+# expand_file: returns (seen, runs, messages, pos_freq) of a file.
+def expand_file((filename, encoding, runsize, tmpdir)):
+  seen = False
+  runs = []
+  messages = []
+  pos_freq = {}
+  dic = {}
+  fp = file(filename)
+  for (lineno, line) in enumerate(fp):
+    seen = True
+    try:
+      line = unicode(line.strip(), encoding)
+    except UnicodeError:
+      messages.append('UnicodeError: filename=%r, lineno=%d' % (filename, lineno+1))
+      continue
+    if not line: continue
+    try:
+      r = expand1(line)
+    except ValueError:
+      messages.append('FormatError: filename=%r, lineno=%d: %r' % (filename, lineno+1, line))
+      continue
+    for (pos1, words) in r:
+      for (w,y) in words:
+        d = dic.setdefault(w, [])
+        if y not in d:
+          d.append(y)
+      pos_freq[pos1] = pos_freq.get(pos1, 0)+1
+    if runsize <= len(dic):
+      runs.append(spilldic(dic, tmpdir))
+      dic = {}
+  fp.close()
+  if dic:
+    runs.append(spilldic(dic, tmpdir))
+  return (seen, runs, messages, pos_freq)
+
+def expand_pubdic_sorted(args, encoding='euc-jp', verbose=0,
+                         nprocs=1, runsize=100000, tmpdir=None):
+  import tempfile, shutil
+  from pycdb import mergeruns
+  # every run goes to a private directory that is removed at the end,
+  # even if a worker fails halfway.
+  rundir = tempfile.mkdtemp(suffix='.runs', dir=tmpdir)
+  try:
+    tasks = [ (filename, encoding, runsize, rundir) for filename in args ]
+    if 1 < nprocs:
+      from multiprocessing import Pool
+      pool = Pool(nprocs)
+      try:
+        results = pool.map(expand_file, tasks, 1)
+      finally:
+        pool.terminate()
+    else:
+      results = map(expand_file, tasks)
+
+    runs = []
+    pos_freq = {}
+    for (filename, (seen, paths, messages, freq)) in zip(args, results):
+      if seen:
+        print '# filename=%r' % filename
+      for msg in messages:
+        print >>stderr, msg
+      runs.extend(paths)
+      for (pos1, n) in freq.iteritems():
+        pos_freq[pos1] = pos_freq.get(pos1, 0)+n
+
+    w0 = None
+    d = []
+    for (w,_,ys) in mergeruns(runs, iterrun, spill, rundir):
+      if w != w0:
+        if d:
+          print ('%s %s' % (w0, ' '.join(d))).encode(encoding)
+        w0 = w
+        d = []
+      for y in ys:
+        if y not in d:
+          d.append(y)
+    if d:
+      print ('%s %s' % (w0, ' '.join(d))).encode(encoding)
+  finally:
+    shutil.rmtree(rundir, True)
+
+  if verbose:
+    for pos1 in sorted(pos_freq.iterkeys()):
+      print >>stderr, '%s: %d' % (pos1, pos_freq[pos1])
+  return
+
+
 # main
 def main(argv):
   import getopt
   def usage():
-    print 'usage: %s [file ...]' % argv[0]
+    print 'usage: %s [-s] [-j nprocs] [-r runsize] [-T tmpdir] [file ...]' % argv[0]
     return 100
   try:
-    (opts, args) = getopt.getopt(argv[1:], '')
+    (opts, args) = getopt.getopt(argv[1:], 'sj:r:T:')
   except getopt.GetoptError:
     return usage()
+  sort = False
+  nprocs = 1
+  runsize = 100000
+  tmpdir = None
+  for (k, v) in opts:
+    if k == '-s': sort = True
+    elif k == '-j': (sort, nprocs) = (True, int(v))
+    elif k == '-r': (sort, runsize) = (True, int(v))
+    elif k == '-T': (sort, tmpdir) = (True, v)
+  if sort and args:
+    return expand_pubdic_sorted(args, nprocs=nprocs, runsize=runsize, tmpdir=tmpdir)
   return expand_pubdic(args)
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
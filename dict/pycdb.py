@@ -6,14 +6,16 @@
 #   * public domain *
 # 
 
-import sys, os
-from struct import pack, unpack
+import sys, os, heapq, marshal, mmap
+from struct import pack, unpack, unpack_from
 from array import array
 
 
 # calc hash value with a given key
 def cdbhash(s, n=5381L):
-  return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffL, s, n)
+  for c in s:
+    n = ((n*33) ^ ord(c)) & 0xffffffffL
+  return n
 
 if pack('=i',1) == pack('>i',1):
   # big endian
@@ -33,6 +35,51 @@ else:
     return a.tostring()
 
 
+##  64-bit variant
+##
+##  Files over 4GB use 64-bit positions and hashes. Such a file starts
+##  with a zero word (a 32-bit file starts with the position of its
+##  first table, which is never zero) followed by a magic:
+##
+##    header: 0, 'CD64', version, 0    (4 x uint32)
+##    256 x (pos, ncells)              (2 x uint64)
+##    records: klen, vlen, key, value  (as in the 32-bit format)
+##    tables: (hash, pos) cells        (2 x uint64)
+##
+CDB64_MAGIC = 'CD64'
+CDB64_VERSION = 1
+
+def cdbhash64(s, n=5381L):
+  for c in s:
+    n = ((n*33) ^ ord(c)) & 0xffffffffffffffffL
+  return n
+
+# (hash function, cell format, cell size, start of records)
+CDB32 = (cdbhash, '<II', 8, 2048)
+CDB64 = (cdbhash64, '<QQ', 16, 16+4096)
+
+# cdbformat: returns (wide, [(pos, ncells), ...]) of an open file.
+def cdbformat(fp):
+  fp.seek(0)
+  head = fp.read(16)
+  if head[:8] == pack('<I', 0)+CDB64_MAGIC:
+    (_, _, version, _) = unpack('<I4sII', head)
+    if version != CDB64_VERSION: raise ValueError('unsupported version: %d' % version)
+    a = unpack('<512Q', fp.read(4096))
+    wide = True
+  else:
+    fp.seek(0)
+    a = decode(fp.read(2048))
+    wide = False
+  return (wide, [ (a[i], a[i+1]) for i in xrange(0, 512, 2) ])
+
+# cdbcells: decodes a string of hash cells.
+def cdbcells(x, wide):
+  if wide:
+    return unpack('<%dQ' % (len(x)/8), x)
+  return decode(x)
+
+
 ##  CDB
 ##
 
@@ -56,8 +103,8 @@ class CDBReader(object):
   def __init__(self, cdbname):
     self.name = cdbname
     self._fp = file(cdbname, 'rb')
-    hash0 = decode(self._fp.read(2048))
-    self._hash0 = [ (hash0[i], hash0[i+1]) for i in xrange(0, 512, 2) ]
+    (self._wide, self._hash0) = cdbformat(self._fp)
+    (self._hash, self._cell, self._cellsize, self._start) = CDB64 if self._wide else CDB32
     self._hash1 = [ None ] * 256
     (self._eod,_) = self._hash0[0]
     return
@@ -73,14 +120,14 @@ class CDBReader(object):
 
   def __getitem__(self, k):
     k = str(k)
-    h = cdbhash(k)
+    h = self._hash(k)
     h1 = h & 0xff
     (pos_bucket, ncells) = self._hash0[h1]
     if ncells == 0: raise KeyError(k)
     hs = self._hash1[h1]
     if hs == None:
       self._fp.seek(pos_bucket)
-      hs = decode(self._fp.read(ncells * 8))
+      hs = cdbcells(self._fp.read(ncells * self._cellsize), self._wide)
       self._hash1[h1] = hs
     i = ((h >> 8) % ncells) * 2
     n = ncells*2
@@ -123,34 +170,63 @@ class CDBReader(object):
       self[startkey]
       self._fp.seek(self._lastpos)
     else:
-      self._fp.seek(2048)
+      self._fp.seek(self._start)
     return ( k for (k,v) in cdbiter(self._fp, self._eod) )
   def itervalues(self, startkey=None):
     if startkey != None:
       self[startkey]
       self._fp.seek(self._lastpos)
     else:
-      self._fp.seek(2048)
+      self._fp.seek(self._start)
     return ( v for (k,v) in cdbiter(self._fp, self._eod) )
   def iteritems(self, startkey=None):
     if startkey != None:
       self[startkey]
       self._fp.seek(self._lastpos)
     else:
-      self._fp.seek(2048)
+      self._fp.seek(self._start)
     return cdbiter(self._fp, self._eod)
 
 
+# cdbfill: places the cells of a bucket by linear probing.
+def cdbfill(b1):
+  return encode(array('I', _cdbfill(b1)))
+def cdbfill64(b1):
+  cells = _cdbfill(b1)
+  return pack('<%dQ' % len(cells), *cells)
+def _cdbfill(b1):
+  n = len(b1)
+  cells = [0]*(n*2)
+  for j in xrange(0, n, 2):
+    (h,p) = (b1[j],b1[j+1])
+    i = ((h >> 8) % n)*2
+    while cells[i+1]:                   # is cell[i] already occupied?
+      i = (i+2) % (n*2)
+    cells[i] = h
+    cells[i+1] = p
+  return cells
+
+
 # CDBMaker
 class CDBMaker(object):
 
-  def __init__(self, cdbname, tmpname):
+  BUFSIZE = 1<<20
+
+  # wide: writes the 64-bit variant.
+  def __init__(self, cdbname, tmpname, wide=False):
     self.fn = cdbname
     self.fntmp = tmpname
     self.numentries = 0
     self._fp = file(tmpname, 'wb')
-    self._pos = 2048                    # sizeof((h,p))*256
-    self._bucket = [ array('I') for _ in xrange(256) ]
+    self._wide = wide
+    (self._hash, _, self._cellsize, self._pos) = CDB64 if wide else CDB32
+    self._fp.seek(self._pos)
+    self._buf = []
+    self._buflen = 0
+    if wide:
+      self._bucket = [ [] for _ in xrange(256) ]
+    else:
+      self._bucket = [ array('I') for _ in xrange(256) ]
     return
 
   def __repr__(self):
@@ -165,14 +241,25 @@ class CDBMaker(object):
   def __setstate__(self, dict):
     raise TypeError
 
+  # records are written sequentially in large blocks.
+  def _write(self, s):
+    self._buf.append(s)
+    self._buflen += len(s)
+    if self.BUFSIZE <= self._buflen:
+      self._flush()
+    return
+
+  def _flush(self):
+    self._fp.write(''.join(self._buf))
+    self._buf = []
+    self._buflen = 0
+    return
+
   def add(self, k, v):
     (k, v) = (str(k), str(v))
     (klen, vlen) = (len(k), len(v))
-    self._fp.seek(self._pos)
-    self._fp.write(pack('<II', klen, vlen))
-    self._fp.write(k)
-    self._fp.write(v)
-    h = cdbhash(k)
+    self._write(pack('<II', klen, vlen)+k+v)
+    h = self._hash(k)
     b = self._bucket[h % 256]
     b.append(h)
     b.append(self._pos)
@@ -181,30 +268,36 @@ class CDBMaker(object):
     self.numentries += 1
     return self
   
-  def finish(self):
-    self._fp.seek(self._pos)
+  # the bucket tables are independent, so they can be
+  # built by nprocs processes.
+  def finish(self, nprocs=1):
+    self._flush()
     pos_hash = self._pos
     # write hashes
-    for b1 in self._bucket:
-      if not b1: continue
-      blen = len(b1)
-      a = array('I', [0]*blen*2)
-      for j in xrange(0, blen, 2):
-        (h,p) = (b1[j],b1[j+1])
-        i = ((h >> 8) % blen)*2
-        while a[i+1]:             # is cell[i] already occupied?
-          i = (i+2) % len(a)
-        a[i] = h
-        a[i+1] = p
-      self._fp.write(encode(a))
+    buckets = [ b1 for b1 in self._bucket if b1 ]
+    fill = cdbfill64 if self._wide else cdbfill
+    if 1 < nprocs:
+      from multiprocessing import Pool
+      pool = Pool(nprocs)
+      try:
+        tables = pool.map(fill, buckets)
+      finally:
+        pool.terminate()
+    else:
+      tables = map(fill, buckets)
+    self._fp.write(''.join(tables))
     # write header
     self._fp.seek(0)
-    a = array('I')
+    a = []
     for b1 in self._bucket:
       a.append(pos_hash)
       a.append(len(b1))
-      pos_hash += len(b1)*8
-    self._fp.write(encode(a))
+      pos_hash += len(b1)*self._cellsize
+    if self._wide:
+      self._fp.write(pack('<I4sII', 0, CDB64_MAGIC, CDB64_VERSION, 0))
+      self._fp.write(pack('<512Q', *a))
+    else:
+      self._fp.write(encode(array('I', a)))
     # close
     self._fp.close()
     os.rename(self.fntmp, self.fn)
@@ -231,37 +324,99 @@ class CDBMaker(object):
 # cdbdump
 def cdbdump(cdbname):
   fp = file(cdbname, 'rb')
-  (eor,) = unpack('<I', fp.read(4))
-  fp.seek(2048)
-  return cdbiter(fp, eor)
+  (wide, hash0) = cdbformat(fp)
+  fp.seek((CDB64 if wide else CDB32)[3])
+  return cdbiter(fp, hash0[0][0])
 
 
-# cdbmerge
+# cdbmerge: merges iterators of (k,v) that are sorted by key.
 def cdbmerge(iters):
-  q = []
-  for it in iters:
-    try:
-      q.append((it.next(),it))
-    except StopIteration:
-      pass
   k0 = None
   vs = None
-  while q:
-    q.sort()
-    ((k,v),it) = q.pop(0)
+  for (k,v) in heapq.merge(*iters):
     if k0 != k:
       if vs: yield (k0,vs)
       vs = []
     vs.append(v)
     k0 = k
-    try:
-      q.append((it.next(),it))
-    except StopIteration:
-      continue
   if vs: yield (k0,vs)
   return
 
 
+# mergeruns: merges sorted run files with at most fanin of them open
+# at a time. Groups of consecutive runs are merged into new runs until
+# at most fanin are left, so the order of equal items is kept.
+# load(path, runno) reads a run back and dump(items, tmpdir) writes
+# a new run and returns its path. All the runs are removed at the end.
+FANIN = 64
+def mergeruns(runs, load, dump, tmpdir=None, fanin=FANIN):
+  runs = list(runs)
+  live = set(runs)
+  try:
+    while fanin < len(runs):
+      merged = []
+      for i in xrange(0, len(runs), fanin):
+        group = runs[i:i+fanin]
+        path = dump(heapq.merge(*[ load(x, j) for (j,x) in enumerate(group) ]), tmpdir)
+        live.add(path)
+        merged.append(path)
+        for x in group:
+          os.unlink(x)
+          live.discard(x)
+      runs = merged
+    for x in heapq.merge(*[ load(path, i) for (i,path) in enumerate(runs) ]):
+      yield x
+  finally:
+    removeruns(live)
+  return
+
+def removeruns(runs):
+  for path in runs:
+    try:
+      os.unlink(path)
+    except OSError:
+      pass
+  return
+
+
+# extsort: sorts an iterator of (k,v) in runs of at most runsize
+# items spilled to temporary files, and merges the runs back.
+def extsort(it, runsize=100000, tmpdir=None):
+  runs = []
+  try:
+    while 1:
+      a = [ x for (_,x) in zip(xrange(runsize), it) ]
+      if not a: break
+      a.sort()
+      runs.append(_spill(a, tmpdir))
+  except:
+    removeruns(runs)
+    raise
+  return mergeruns(runs, _iterrun, _spill, tmpdir)
+
+def _spill(items, tmpdir):
+  import tempfile
+  (fd, path) = tempfile.mkstemp(suffix='.run', dir=tmpdir)
+  fp = os.fdopen(fd, 'wb')
+  for x in items:
+    marshal.dump(x, fp)
+  fp.close()
+  return path
+
+def _iterrun(path, runno):
+  fp = file(path, 'rb')
+  try:
+    while 1:
+      try:
+        x = marshal.load(fp)
+      except EOFError:
+        break
+      yield x
+  finally:
+    fp.close()
+  return
+
+
 # aliases
 cdbmake = CDBMaker
 init = CDBReader
@@ -270,33 +425,46 @@ init = CDBReader
 ##  TCDB
 ##
 
-# tcdbiter
+# tcdbiter: reads the records in file order without a map of the
+# whole table. The parent of each record is the open record whose
+# hash cell for it points back to it, found by probing the table.
 def tcdbiter(fp, eor):
-  locs = {}
-  fp.seek(eor)
-  while 1:
-    x = fp.read(8)
-    if not x: break
-    (h, pos) = unpack('<II', x)
-    if pos: locs[pos] = h
-  pos = 2048
-  fp.seek(pos)
+  (wide, buckets) = cdbformat(fp)
+  (hashf, cell, cellsize, pos) = CDB64 if wide else CDB32
+  mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  def find(k, parent, pos):
+    h = hashf(k, parent+5381L)
+    (pos_bucket, ncells) = buckets[h % 256]
+    if ncells == 0: return False
+    start = (h >> 8) % ncells
+    for i in xrange(ncells):
+      (h1, p1) = unpack_from(cell, mm, pos_bucket + (start+i) % ncells * cellsize)
+      if p1 == 0: break
+      if p1 == pos: return h1 == h
+    return False
+  # most records are a sibling or a child of the previous one,
+  # so those two are tried first.
+  orders = [[], [0]]
   key = ()
   parents = [0]
   while pos < eor:
-    (klen, vlen) = unpack('<II', fp.read(8))
-    k = fp.read(klen)
-    v = fp.read(vlen)
-    h = locs[pos]
-    for (i,p) in enumerate(parents):
-      if cdbhash(k, p+5381L) == h:
-        parents = parents[:i+1]
+    (klen, vlen) = unpack_from('<II', mm, pos)
+    k = mm[pos+8:pos+8+klen]
+    v = mm[pos+8+klen:pos+8+klen+vlen]
+    n = len(parents)
+    while len(orders) <= n:
+      m = len(orders)
+      orders.append([m-2, m-1]+range(m-3, -1, -1))
+    for i in orders[n]:
+      if find(k, parents[i], pos):
+        del parents[i+1:]
         key = key[:i]
         break
     key += (k,)
     yield (key, v)
     parents.append(pos)
     pos += 8+klen+vlen
+  mm.close()
   fp.close()
   return
 
@@ -304,33 +472,31 @@ def tcdbiter(fp, eor):
 # TCDBMaker
 class TCDBMaker(CDBMaker):
 
-  def __init__(self, cdbname, tmpname):
-    CDBMaker.__init__(self, cdbname, tmpname)
+  def __init__(self, cdbname, tmpname, wide=False):
+    CDBMaker.__init__(self, cdbname, tmpname, wide=wide)
     self._parent = 0
     self._stack = [self._parent]
     return
 
   def put(self, depth, k, v):
-    if depth == len(self._stack)+1:
-      self._stack.append(self._parent)
-    elif depth < len(self._stack):
-      self._stack = self._stack[:depth]
-    elif depth != len(self._stack):
+    stack = self._stack
+    if depth == len(stack)+1:
+      stack.append(self._parent)
+    elif depth < len(stack):
+      del stack[depth:]
+    elif depth != len(stack):
       raise ValueError('invalid depth: %d' % depth)
     #
     (k, v) = (str(k), str(v))
     (klen, vlen) = (len(k), len(v))
-    self._parent = self._pos
+    pos = self._parent = self._pos
     # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
-    self._fp.seek(self._pos)
-    self._fp.write(pack('<II', klen, vlen))
-    self._fp.write(k)
-    self._fp.write(v)
-    self._pos += 4+4+klen+vlen
-    h = cdbhash(k, self._stack[-1]+5381L)
+    self._write(pack('<II', klen, vlen)+k+v)
+    self._pos = pos+4+4+klen+vlen
+    h = self._hash(k, stack[-1]+5381L)
     b = self._bucket[h % 256]
     b.append(h)
-    b.append(self._parent)
+    b.append(pos)
     self.numentries += 1
     return self
 
@@ -363,14 +529,13 @@ class TCDBReader(CDBReader):
 
   def lookup1(self, k, parent=0L):
     k = str(k)
-    h = cdbhash(k, parent+5381L)
-    self._fp.seek((h % 256) << 3)
-    (pos_bucket, ncells) = unpack('<II', self._fp.read(8))
+    h = self._hash(k, parent+5381L)
+    (pos_bucket, ncells) = self._hash0[h % 256]
     if ncells == 0: raise KeyError(k)
     start = (h >> 8) % ncells
     for i in xrange(ncells):
-      self._fp.seek(pos_bucket + ((start+i) % ncells << 3))
-      (h1, p1) = unpack('<II', self._fp.read(8))
+      self._fp.seek(pos_bucket + (start+i) % ncells * self._cellsize)
+      (h1, p1) = unpack(self._cell, self._fp.read(self._cellsize))
       if p1 == 0: raise KeyError(k)
       if h1 == h:
         self._fp.seek(p1)
@@ -392,8 +557,8 @@ class TCDBReader(CDBReader):
 # tcdbdump
 def tcdbdump(cdbname):
   fp = file(cdbname, 'rb')
-  (eor,) = unpack('<I', fp.read(4))
-  return tcdbiter(fp, eor)
+  (_, hash0) = cdbformat(fp)
+  return tcdbiter(fp, hash0[0][0])
 
 
 # aliases
@@ -402,26 +567,115 @@ tcdbinit = TCDBReader
 tcdbmerge = cdbmerge
 
 
+##  TTRIE
+##
+##  A compact, versioned trie over codepoints for read-only use.
+##  Nodes are numbered breadth first, so the children of a node are
+##  consecutive and are found by binary search of their codepoints:
+##
+##    header: 'TTRI', version, nnodes, nbytes    (4 x uint32)
+##    first[nnodes+1]: id of the first child of each node
+##    chars[nnodes]: codepoint of the edge into each node
+##    voffs[nnodes+1]: offset of the value of each node
+##    values[nbytes]: all the values
+##
+##  Numbers are little-endian uint32, so that every array is aligned
+##  for memory mapping. Node 0 is the root.
+##
+TTRIE_MAGIC = 'TTRI'
+TTRIE_VERSION = 1
+
+# TTrieMaker
+class TTrieMaker(object):
+
+  def __init__(self, name, tmpname):
+    self.fn = name
+    self.fntmp = tmpname
+    self.numentries = 0
+    self._root = [{}, '']
+    return
+
+  def __repr__(self):
+    return '<TTrieMaker: %r, %r, %d ents>' % (self.fn, self.fntmp, self.numentries)
+
+  def __len__(self):
+    return self.numentries
+
+  # key is a unicode string.
+  def add(self, key, v):
+    node = self._root
+    for c in key:
+      node = node[0].setdefault(ord(c), [{}, ''])
+    node[1] = str(v)
+    self.numentries += 1
+    return self
+
+  def finish(self):
+    first = array('I')
+    chars = array('I', [0])
+    voffs = array('I', [0])
+    values = []
+    nbytes = 0
+    nodes = [self._root]
+    i = 0
+    while i < len(nodes):
+      (children, v) = nodes[i]
+      first.append(len(nodes))
+      for c in sorted(children):
+        chars.append(c)
+        nodes.append(children[c])
+      values.append(v)
+      nbytes += len(v)
+      voffs.append(nbytes)
+      i += 1
+    first.append(len(nodes))
+    fp = file(self.fntmp, 'wb')
+    fp.write(pack('<4sIII', TTRIE_MAGIC, TTRIE_VERSION, len(nodes), nbytes))
+    fp.write(encode(first))
+    fp.write(encode(chars))
+    fp.write(encode(voffs))
+    fp.write(''.join(values))
+    fp.close()
+    os.rename(self.fntmp, self.fn)
+    return
+
+  # tcdb2ttrie: keys are decoded with codec.
+  def tcdb2ttrie(self, tcdbname, codec):
+    for (k,v) in tcdbdump(tcdbname):
+      self.add(''.join(k).decode(codec), v)
+    return self
+
+
 # main
 def main(argv):
   import getopt, fileinput
   def usage():
     print 'usage: %s {cmake,cget,cdump,cmerge} [options] cdbname [args ...]' % argv[0]
     print 'usage: %s {tmake,tget,tdump,tmerge} [options] tcdbname [args ...]' % argv[0]
+    print 'usage: %s {cmerge,tmerge} [-s] [-r runsize] dbname [dbname ...]' % argv[0]
+    print 'usage: %s {ccopy,tcopy} [-W] dbname srcname' % argv[0]
+    print 'usage: %s tconv [-c codec] ttriename tcdbname' % argv[0]
     return 100
   args = argv[1:]
   if not args: return usage()
   cmd = args.pop(0)
   try:
-    (opts, args) = getopt.getopt(args, 'kv2')
+    (opts, args) = getopt.getopt(args, 'kv2c:sr:W')
   except getopt.GetoptError:
     return usage()
   if not args: return usage()
   dbname = args.pop(0)
+  # sort the inputs of cmerge/tmerge before merging.
+  sort = None
+  wide = False
+  for (k, v) in opts:
+    if k == '-s': sort = sort or 100000
+    elif k == '-r': sort = int(v)
+    elif k == '-W': wide = True
   
   # cdb
   if cmd == 'cmake':
-    CDBMaker(dbname, dbname+'.tmp').txt2cdb(fileinput.input(args)).finish()
+    CDBMaker(dbname, dbname+'.tmp', wide).txt2cdb(fileinput.input(args)).finish()
   elif cmd == 'cget':
     print repr(CDBReader(dbname).get(args[0]))
   elif cmd == 'cdump':
@@ -435,13 +689,21 @@ def main(argv):
     print
   elif cmd == 'cmerge':
     dbs = [ cdbdump(fname) for fname in args ]
-    m = CDBMaker(dbname, dbname+'.tmp')
+    if sort:
+      dbs = [ extsort(db, sort) for db in dbs ]
+    m = CDBMaker(dbname, dbname+'.tmp', wide)
     for (k,vs) in tcdbmerge(dbs):
       m.add(k, ' '.join(vs))
     m.finish()
+  elif cmd == 'ccopy':
+    if not args: return usage()
+    m = CDBMaker(dbname, dbname+'.tmp', wide)
+    for (k,v) in cdbdump(args[0]):
+      m.add(k, v)
+    m.finish()
   # tcdb
   elif cmd == 'tmake':
-    TCDBMaker(dbname, dbname+'.tmp').txt2tcdb(fileinput.input(args)).finish()
+    TCDBMaker(dbname, dbname+'.tmp', wide).txt2tcdb(fileinput.input(args)).finish()
   elif cmd == 'tget':
     print repr(TCDBReader(dbname).lookup(args))
   elif cmd == 'tdump':
@@ -450,15 +712,36 @@ def main(argv):
       if k == '-k': f = (lambda k,_: '/'.join(k))
       elif k == '-v': f = (lambda _,v: v)
       elif k == '-2': f = (lambda k,v: '/'.join(k)+'\t'+v)
+    out = []
     for (k,v) in tcdbdump(dbname):
-      print f(k,v)
-    print
+      out.append(f(k,v))
+      if 4096 <= len(out):
+        out.append('')
+        sys.stdout.write('\n'.join(out))
+        out = []
+    out.append('\n')
+    sys.stdout.write('\n'.join(out))
   elif cmd == 'tmerge':
     dbs = [ tcdbdump(fname) for fname in args ]
-    m = TCDBMaker(dbname, dbname+'.tmp')
+    if sort:
+      dbs = [ extsort(db, sort) for db in dbs ]
+    m = TCDBMaker(dbname, dbname+'.tmp', wide)
     for (k,vs) in tcdbmerge(dbs):
       m.put(len(k), k[-1], ' '.join(vs))
     m.finish()
+  elif cmd == 'tcopy':
+    if not args: return usage()
+    m = TCDBMaker(dbname, dbname+'.tmp', wide)
+    for (k,v) in tcdbdump(args[0]):
+      m.put(len(k), k[-1], v)
+    m.finish()
+  # ttrie
+  elif cmd == 'tconv':
+    codec = 'utf-8'
+    for (k, v) in opts:
+      if k == '-c': codec = v
+    if not args: return usage()
+    TTrieMaker(dbname, dbname+'.tmp').tcdb2ttrie(args[0], codec).finish()
     
   else:
     return usage()
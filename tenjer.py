@@ -27,9 +27,12 @@
 ###  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 ### 
 
-import sys, re, os.path
-from struct import pack, unpack
+import sys, re, os.path, mmap, threading, time, codecs, hashlib
+from struct import pack, unpack, unpack_from
 from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import islice
 
 
 ##  utilities
@@ -54,6 +57,39 @@ else:
     def encode(a):
         return a.tostring()
 
+# The 64-bit variant starts with a zero word and a magic,
+# followed by 256 (pos, ncells) pairs of uint64.
+CDB64_MAGIC = 'CD64'
+CDB64_VERSION = 1
+
+def cdbhash64(s, n=5381L):
+    return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffffffffffL, s, n)
+
+# (hash function, cell format, cell size, start of records)
+CDB32 = (cdbhash, '<II', 8, 2048)
+CDB64 = (cdbhash64, '<QQ', 16, 16+4096)
+
+# returns (wide, [(pos, ncells), ...]) of an open file.
+def cdbformat(fp):
+    fp.seek(0)
+    head = fp.read(16)
+    if head[:8] == pack('<I', 0)+CDB64_MAGIC:
+        (_, _, version, _) = unpack('<I4sII', head)
+        if version != CDB64_VERSION:
+            raise ValueError('unsupported version: %d' % version)
+        a = unpack('<512Q', fp.read(4096))
+        wide = True
+    else:
+        fp.seek(0)
+        a = decode(fp.read(2048))
+        wide = False
+    return (wide, [ (a[i], a[i+1]) for i in xrange(0, 512, 2) ])
+
+def cdbcells(x, wide):
+    if wide:
+        return unpack('<%dQ' % (len(x)/8), x)
+    return decode(x)
+
 HIRA2KATA = dict( (c, c+96) for c in xrange(0x3041,0x3094) )
 def hira2kata(s):
     return s.translate(HIRA2KATA)
@@ -71,6 +107,13 @@ def zen2han(s):
 def decode_yomi(s):
     return u''.join( unichr(0x3000+ord(c)) for c in s )
 
+# the inverse of decode_yomi (katakana and the long vowel mark only).
+def encode_yomi(s):
+    for c in s:
+        if not (u'\u30a1' <= c <= u'\u30f4' or c == u'\u30fc'):
+            raise ValueError('invalid reading: %r' % s)
+    return ''.join( chr(ord(c)-0x3000) for c in s )
+
 POST = { ord(u''):u'', ord(u''):u'' }
 EUPH = re.compile(ur'([ȥɥΥۥܥݥ祩])')
 def reg_yomi(s):
@@ -79,6 +122,53 @@ def reg_yomi(s):
     s = EUPH.sub(ur'\1', s)
     return s
 
+# clone: a shallow copy of a parser. The parsers keep their state in
+# the instance, so each call parses on a private copy and the object
+# itself can be shared between threads. This is done for every chunk,
+# so it skips the generic machinery of copy.copy.
+def clone(obj):
+    p = object.__new__(obj.__class__)
+    p.__dict__.update(obj.__dict__)
+    return p
+
+# a class attribute computed on its first access, then stored
+# in the class so that later accesses are plain lookups.
+class lazyattr(object):
+
+    def __init__(self, func):
+        self.func = func
+        return
+
+    def __get__(self, obj, cls):
+        v = self.func(cls)
+        setattr(cls, self.func.__name__, v)
+        return v
+
+# classify a whole string into kind codes (u'\x00'-u'\x06') at once.
+# KindMap is a translate table given as (u'first last', kind) ranges,
+# later ones taking precedence. Each codepoint is resolved on its first
+# use and then kept, so nothing is enumerated at import time.
+# Anything outside the ranges (including the codes themselves) is 0.
+class KindMap(dict):
+
+    def __init__(self, ranges):
+        dict.__init__(self)
+        self._ranges = [ (ord(c[0]), ord(c[-1]), unichr(k)) for (c,k) in reversed(ranges) ]
+        return
+
+    def __missing__(self, i):
+        k = u'\x00'
+        for (i0, i1, k1) in self._ranges:
+            if i0 <= i <= i1:
+                k = k1
+                break
+        self[i] = k
+        return k
+
+KINDRUN = [ re.compile(u'%s+' % unichr(k)) for k in xrange(7) ]
+def classify(s, kmap):
+    return s.translate(kmap)
+
 
 ##  CDB
 ##
@@ -88,8 +178,12 @@ class CDBReader(object):
         self.name = cdbname
         self.codec = codec
         self._fp = file(cdbname, 'rb')
-        hash0 = decode(self._fp.read(2048))
-        self._hash0 = [ (hash0[i], hash0[i+1]) for i in xrange(0, 512, 2) ]
+        # a file object for each thread, so that no seek+read is shared
+        # and the reads need no lock.
+        self._local = threading.local()
+        self._local.fp = self._fp
+        (self._wide, self._hash0) = cdbformat(self._fp)
+        (self._hash, self._cell, self._cellsize, self._start) = CDB64 if self._wide else CDB32
         self._hash1 = [ None ] * 256
         (self._eod,_) = self._hash0[0]
         return
@@ -103,16 +197,25 @@ class CDBReader(object):
     def __setstate__(self, dict):
         raise TypeError
 
+    # the file object of the calling thread.
+    def _file(self):
+        try:
+            return self._local.fp
+        except AttributeError:
+            fp = self._local.fp = file(self.name, 'rb')
+            return fp
+
     def __getitem__(self, k):
         k = k.encode(self.codec, 'ignore')
-        h = cdbhash(k)
+        h = self._hash(k)
         h1 = h & 0xff
         (pos_bucket, ncells) = self._hash0[h1]
         if ncells == 0: raise KeyError(k)
+        fp = self._file()
         hs = self._hash1[h1]
         if hs == None:
-            self._fp.seek(pos_bucket)
-            hs = decode(self._fp.read(ncells * 8))
+            fp.seek(pos_bucket)
+            hs = cdbcells(fp.read(ncells * self._cellsize), self._wide)
             self._hash1[h1] = hs
         i = ((h >> 8) % ncells) * 2
         n = ncells*2
@@ -120,12 +223,12 @@ class CDBReader(object):
             p1 = hs[i+1]
             if p1 == 0: raise KeyError(k)
             if hs[i] == h:
-                self._fp.seek(p1)
-                self._lastpos = self._fp.tell()
-                (klen, vlen) = unpack('<II', self._fp.read(8))
-                k1 = self._fp.read(klen)
+                fp.seek(p1)
+                self._lastpos = fp.tell()
+                (klen, vlen) = unpack('<II', fp.read(8))
+                k1 = fp.read(klen)
                 if k1 == k:
-                    v1 = self._fp.read(vlen)
+                    v1 = fp.read(vlen)
                     return v1
             i = (i+2) % n
         raise KeyError(k)
@@ -151,9 +254,13 @@ class CDBReader(object):
         return self.has_key(k)
 
 
-##  TCDB
+##  TrieLookup
+##
+##  The walks of a trie dictionary built on its find1(k, parent),
+##  which returns (value, state) or None for a missing edge.
+##  Readers override them only where they have a faster way.
 ##
-class TCDBReader(CDBReader):
+class TrieLookup(object):
 
     def lookup(self, seq, parent=0L):
         r = []
@@ -163,32 +270,638 @@ class TCDBReader(CDBReader):
         return r
 
     def lookup1(self, k, parent=0L):
+        x = self.find1(k, parent)
+        if x is None: raise KeyError(k)
+        return x
+
+    # returns [(end, v, parent), ...] for every node on the path
+    # s[i:j], stopping at the first missing edge.
+    def prefixes(self, s, i=0, j=None, parent=0L):
+        if j is None: j = len(s)
+        r = []
+        while i < j:
+            x = self.find1(s[i], parent)
+            if x is None: break
+            (v, parent) = x
+            i += 1
+            r.append((i, v, parent))
+        return r
+
+
+##  TCDB
+##
+class TCDBReader(CDBReader, TrieLookup):
+
+    def __init__(self, cdbname, codec):
+        CDBReader.__init__(self, cdbname, codec)
+        self._filter = None
+        self._profiler = None
+        return
+
+    # installs (or removes with None) a Profiler.
+    # The plain find1 is left untouched while profiling is off.
+    def set_profiler(self, profiler):
+        self._profiler = profiler
+        if profiler is None:
+            self.__dict__.pop('find1', None)
+        else:
+            self.find1 = self._find1_prof
+        return
+
+    def _pread(self, pos, n):
+        fp = self._file()
+        fp.seek(pos)
+        return fp.read(n)
+
+    # builds a bitset of the hash values of all the records
+    # so that most of the missing edges are rejected without probing.
+    def build_filter(self, bits=20):
+        fp = self._file()
+        fp.seek(self._eod)
+        a = cdbcells(fp.read(), self._wide)
+        mask = (1 << bits)-1
+        f = bytearray((mask >> 3)+1)
+        for i in xrange(0, len(a), 2):
+            if a[i+1]:
+                x = a[i] & mask
+                f[x >> 3] |= 1 << (x & 7)
+        self._filter = (f, mask)
+        return
+
+    # yields (parent, pos, key, value) in file order. The parent of a
+    # record is the open record whose hash cell for it points back to
+    # it, found by probing the table, so no map of the table is built.
+    def iterrecords(self):
+        mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        hash0 = self._hash0
+        (hashf, cell, cellsize, pos) = (self._hash, self._cell, self._cellsize, self._start)
+        def find(k, parent, pos):
+            h = hashf(k, parent+5381L)
+            (pos_bucket, ncells) = hash0[h & 0xff]
+            if ncells == 0: return False
+            start = (h >> 8) % ncells
+            for i in xrange(ncells):
+                (h1, p1) = unpack_from(cell, mm, pos_bucket + (start+i) % ncells * cellsize)
+                if p1 == 0: break
+                if p1 == pos: return h1 == h
+            return False
+        # most records are a sibling or a child of the previous one,
+        # so those two are tried first.
+        orders = [[], [0]]
+        parents = [0]
+        try:
+            while pos < self._eod:
+                (klen, vlen) = unpack_from('<II', mm, pos)
+                i = pos+8
+                k = mm[i:i+klen]
+                v = mm[i+klen:i+klen+vlen]
+                n = len(parents)
+                while len(orders) <= n:
+                    m = len(orders)
+                    orders.append([m-2, m-1]+range(m-3, -1, -1))
+                for i in orders[n]:
+                    if find(k, parents[i], pos):
+                        del parents[i+1:]
+                        break
+                yield (parents[-1], pos, k, v)
+                parents.append(pos)
+                pos += 8+klen+vlen
+        finally:
+            mm.close()
+        return
+
+    # same as lookup1 but returns None for a missing edge.
+    def find1(self, k, parent=0L):
         k = k.encode(self.codec, 'ignore')
-        h = cdbhash(k, parent+5381L)
-        self._fp.seek((h % 256) << 3)
-        (pos_bucket, ncells) = unpack('<II', self._fp.read(8))
-        if ncells == 0: raise KeyError(k)
+        h = self._hash(k, parent+5381L)
+        if self._filter is not None:
+            (f, mask) = self._filter
+            x = h & mask
+            if not (f[x >> 3] & (1 << (x & 7))): return None
+        (pos_bucket, ncells) = self._hash0[h % 256]
+        if ncells == 0: return None
         start = (h >> 8) % ncells
+        cellsize = self._cellsize
+        # inlined _file(): this is the hot path.
+        try:
+            fp = self._local.fp
+        except AttributeError:
+            fp = self._file()
         for i in xrange(ncells):
-            self._fp.seek(pos_bucket + ((start+i) % ncells << 3))
-            (h1, p1) = unpack('<II', self._fp.read(8))
-            if p1 == 0: raise KeyError(k)
+            fp.seek(pos_bucket + (start+i) % ncells * cellsize)
+            (h1, p1) = unpack(self._cell, fp.read(cellsize))
+            if p1 == 0: return None
             if h1 == h:
-                self._fp.seek(p1)
-                (klen, vlen) = unpack('<II', self._fp.read(8))
-                k1 = self._fp.read(klen)
+                fp.seek(p1)
+                (klen, vlen) = unpack('<II', fp.read(8))
+                k1 = fp.read(klen)
                 if k1 == k:
-                    v1 = self._fp.read(vlen)
+                    v1 = fp.read(vlen)
                     return (v1,p1)
-        raise KeyError(k)
+        return None
+
+    # find1 with counters, used while a profiler is installed.
+    def _find1_prof(self, k, parent=0L):
+        prof = self._profiler
+        prof.lookups += 1
+        k = k.encode(self.codec, 'ignore')
+        h = self._hash(k, parent+5381L)
+        if self._filter is not None:
+            (f, mask) = self._filter
+            x = h & mask
+            if not (f[x >> 3] & (1 << (x & 7))):
+                prof.filtered += 1
+                prof.misses += 1
+                return None
+        (pos_bucket, ncells) = self._hash0[h % 256]
+        start = (h >> 8) % max(1, ncells)
+        cellsize = self._cellsize
+        for i in xrange(ncells):
+            prof.probes += 1
+            prof.nbytes += cellsize
+            (h1, p1) = unpack(self._cell, self._pread(pos_bucket + (start+i) % ncells * cellsize, cellsize))
+            if p1 == 0: break
+            if h1 == h:
+                (klen, vlen) = unpack('<II', self._pread(p1, 8))
+                x = self._pread(p1+8, klen+vlen)
+                prof.nbytes += 8+klen+vlen
+                if x[:klen] == k:
+                    prof.hits += 1
+                    return (x[klen:],p1)
+        prof.misses += 1
+        return None
+
+
+##  MmapTCDBReader
+##
+##  Reads the mapped file at explicit offsets, so lookups
+##  do not touch the shared file position and need no lock.
+##
+class MmapTCDBReader(TCDBReader):
+
+    def __init__(self, cdbname, codec):
+        TCDBReader.__init__(self, cdbname, codec)
+        self._mm = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+        return
+
+    def __repr__(self):
+        return '<MmapTCDBReader: %r>' % self.name
+
+    def close(self):
+        self._mm.close()
+        TCDBReader.close(self)
+        return
+
+    def _pread(self, pos, n):
+        return self._mm[pos:pos+n]
+
+    def find1(self, k, parent=0L):
+        k = k.encode(self.codec, 'ignore')
+        h = self._hash(k, parent+5381L)
+        if self._filter is not None:
+            (f, mask) = self._filter
+            x = h & mask
+            if not (f[x >> 3] & (1 << (x & 7))): return None
+        mm = self._mm
+        (pos_bucket, ncells) = self._hash0[h % 256]
+        if ncells == 0: return None
+        start = (h >> 8) % ncells
+        (cell, cellsize) = (self._cell, self._cellsize)
+        for i in xrange(ncells):
+            (h1, p1) = unpack_from(cell, mm, pos_bucket + (start+i) % ncells * cellsize)
+            if p1 == 0: return None
+            if h1 == h:
+                (klen, vlen) = unpack_from('<II', mm, p1)
+                p = p1+8
+                if klen == len(k) and mm[p:p+klen] == k:
+                    p += klen
+                    return (mm[p:p+vlen],p1)
+        return None
+
+
+##  TCDBTrie
+##
+##  In-memory copy of a TCDB trie keyed by (parent, codepoint).
+##  The states are the same file positions that TCDBReader uses.
+##
+class TCDBTrie(TrieLookup):
+
+    # find1 needs no I/O (see FusedTranslator).
+    inmemory = True
+
+    def __init__(self, cdbname, codec):
+        self.name = cdbname
+        self.codec = codec
+        self._edges = {}
+        tcdb = TCDBReader(cdbname, codec)
+        try:
+            for (parent, pos, k, v) in tcdb.iterrecords():
+                c = k.decode(codec, 'ignore')
+                if len(c) != 1: continue
+                self._edges[(parent << 21) | ord(c)] = (v, pos)
+        finally:
+            tcdb.close()
+        return
+
+    def __repr__(self):
+        return '<TCDBTrie: %r, %d edges>' % (self.name, len(self._edges))
+
+    def close(self):
+        return
+
+    def prefixes(self, s, i=0, j=None, parent=0L):
+        if j is None: j = len(s)
+        edges = self._edges
+        r = []
+        while i < j:
+            x = edges.get((parent << 21) | ord(s[i]))
+            if x is None: break
+            (v, parent) = x
+            i += 1
+            r.append((i, v, parent))
+        return r
+
+    def find1(self, k, parent=0L):
+        return self._edges.get((parent << 21) | ord(k))
+
+    def set_profiler(self, profiler):
+        self._profiler = profiler
+        if profiler is None:
+            self.__dict__.pop('find1', None)
+            self.__dict__.pop('prefixes', None)
+        else:
+            self.find1 = self._find1_prof
+            # the generic walk goes through the counting find1.
+            self.prefixes = super(TCDBTrie, self).prefixes
+        return
+
+    def _find1_prof(self, k, parent=0L):
+        prof = self._profiler
+        prof.lookups += 1
+        prof.probes += 1
+        x = self._edges.get((parent << 21) | ord(k))
+        if x is None:
+            prof.misses += 1
+        else:
+            prof.hits += 1
+        return x
+
+
+##  TTrieReader
+##
+##  Reads the compact trie written by "pycdb.py tconv" (see the
+##  layout there). The states are node ids, with the root at 0.
+##
+TTRIE_MAGIC = 'TTRI'
+TTRIE_VERSION = 1
+
+def is_ttrie(path):
+    fp = file(path, 'rb')
+    try:
+        return fp.read(4) == TTRIE_MAGIC
+    finally:
+        fp.close()
+
+class TTrieReader(TCDBTrie):
+
+    def __init__(self, cdbname, codec):
+        self.name = cdbname
+        self.codec = codec
+        fp = file(cdbname, 'rb')
+        try:
+            data = fp.read()
+        finally:
+            fp.close()
+        (magic, version, nnodes, nbytes) = unpack_from('<4sIII', data)
+        if magic != TTRIE_MAGIC:
+            raise ValueError('not a ttrie: %r' % cdbname)
+        if version != TTRIE_VERSION:
+            raise ValueError('unsupported ttrie version: %d' % version)
+        i = 16
+        self._first = decode(data[i:i+(nnodes+1)*4])
+        i += (nnodes+1)*4
+        self._chars = decode(data[i:i+nnodes*4])
+        i += nnodes*4
+        self._voffs = decode(data[i:i+(nnodes+1)*4])
+        i += (nnodes+1)*4
+        self._values = data[i:i+nbytes]
+        return
+
+    def __repr__(self):
+        return '<TTrieReader: %r, %d nodes>' % (self.name, len(self._chars))
+
+    def prefixes(self, s, i=0, j=None, parent=0L):
+        if j is None: j = len(s)
+        (first, chars, voffs, values) = (self._first, self._chars, self._voffs, self._values)
+        r = []
+        while i < j:
+            c = ord(s[i])
+            (lo, hi) = (first[parent], first[parent+1])
+            parent = bisect_left(chars, c, lo, hi)
+            if parent == hi or chars[parent] != c: break
+            i += 1
+            r.append((i, values[voffs[parent]:voffs[parent+1]], parent))
+        return r
+
+    def find1(self, k, parent=0L):
+        c = ord(k)
+        chars = self._chars
+        hi = self._first[parent+1]
+        i = bisect_left(chars, c, self._first[parent], hi)
+        if i == hi or chars[i] != c: return None
+        return (self._values[self._voffs[i]:self._voffs[i+1]], i)
+
+    def _find1_prof(self, k, parent=0L):
+        prof = self._profiler
+        prof.lookups += 1
+        prof.probes += 1
+        x = TTrieReader.find1(self, k, parent)
+        if x is None:
+            prof.misses += 1
+        else:
+            prof.hits += 1
+        return x
+
+
+##  TextTrie
+##
+##  A small dictionary read from "word reading" lines (the format of
+##  override.txt), to be used as an overlay. It takes no build step.
+##
+class TextTrie(TCDBTrie):
+
+    def __init__(self, cdbname, codec):
+        self.name = cdbname
+        self.codec = codec
+        self._edges = {}
+        nodes = 0
+        fp = file(cdbname, 'rb')
+        try:
+            for line in fp:
+                line = line.strip()
+                if not line or line.startswith('#'): continue
+                f = line.decode(codec).split(' ')
+                if len(f) < 2: raise ValueError('invalid line: %r' % line)
+                (w, y) = (f[0], encode_yomi(f[1]))
+                parent = 0
+                for (i,c) in enumerate(w):
+                    key = (parent << 21) | ord(c)
+                    (v, pos) = self._edges.get(key, ('', None))
+                    if pos is None:
+                        nodes += 1
+                        pos = nodes
+                    if i == len(w)-1:
+                        v = y
+                    self._edges[key] = (v, pos)
+                    parent = pos
+        finally:
+            fp.close()
+        return
+
+    def __repr__(self):
+        return '<TextTrie: %r, %d edges>' % (self.name, len(self._edges))
+
+
+##  LRUCache
+##
+class LRUCache(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._d = OrderedDict()
+        self._lock = threading.Lock()
+        return
+
+    def __repr__(self):
+        return ('<LRUCache: %d/%d ents, hits=%d, misses=%d, evictions=%d>' %
+                (len(self._d), self.size, self.hits, self.misses, self.evictions))
+
+    def __len__(self):
+        return len(self._d)
+
+    def get(self, k, failed=None):
+        d = self._d
+        with self._lock:
+            try:
+                v = d.pop(k)
+            except KeyError:
+                self.misses += 1
+                return failed
+            d[k] = v
+            self.hits += 1
+        return v
+
+    def put(self, k, v):
+        d = self._d
+        with self._lock:
+            d[k] = v
+            if self.size < len(d):
+                d.popitem(last=False)
+                self.evictions += 1
+        return
+
+
+##  CachedTCDB
+##
+##  Memoizes lookup1 of another reader. Misses are cached as None.
+##
+class CachedTCDB(TrieLookup):
+
+    def __init__(self, tcdb, size):
+        self.tcdb = tcdb
+        self.cache = LRUCache(size)
+        return
+
+    def __repr__(self):
+        return '<CachedTCDB: %r, %r>' % (self.tcdb, self.cache)
+
+    def close(self):
+        self.tcdb.close()
+        return
+
+    def find1(self, k, parent=0L):
+        key = (k, parent)
+        x = self.cache.get(key, self)
+        if x is self:
+            x = self.tcdb.find1(k, parent)
+            self.cache.put(key, x)
+        return x
+
+    # only the lookups that miss the cache reach the profiler.
+    def set_profiler(self, profiler):
+        self.tcdb.set_profiler(profiler)
+        return
+
+
+##  LayeredTCDB
+##
+##  A stack of dictionaries consulted in order: overlays first, then
+##  the base. A state is the tuple of the states of all layers (None
+##  where a layer has no such prefix) and 0 is the root of every layer.
+##  The value of a prefix is the first non-empty value among the layers.
+##
+class LayeredTCDB(TrieLookup):
+
+    def __init__(self, layers):
+        self.layers = layers
+        self._root = (0L,)*len(layers)
+        self._profiler = None
+        return
+
+    def __repr__(self):
+        return '<LayeredTCDB: %r>' % (self.layers,)
+
+    def close(self):
+        for tcdb in self.layers:
+            tcdb.close()
+        return
+
+    def find1(self, k, parent=0L):
+        if parent == 0:
+            parent = self._root
+        v = ''
+        states = []
+        found = False
+        for (tcdb, p) in zip(self.layers, parent):
+            x = None
+            if p is not None:
+                x = tcdb.find1(k, p)
+            if x is None:
+                states.append(None)
+            else:
+                found = True
+                if not v:
+                    v = x[0]
+                states.append(x[1])
+        if not found: return None
+        return (v, tuple(states))
+
+    # a lookup is counted once here; each layer counts its own
+    # lookups into a separate Profiler, which is reported per layer.
+    def set_profiler(self, profiler):
+        self._profiler = profiler
+        if profiler is None:
+            self.__dict__.pop('find1', None)
+        else:
+            self.find1 = self._find1_prof
+            profiler.layers = [ Profiler() for _ in self.layers ]
+        for (i, tcdb) in enumerate(self.layers):
+            if hasattr(tcdb, 'set_profiler'):
+                tcdb.set_profiler(profiler and profiler.layers[i])
+        return
+
+    def _find1_prof(self, k, parent=0L):
+        prof = self._profiler
+        prof.lookups += 1
+        x = LayeredTCDB.find1(self, k, parent)
+        if x is None:
+            prof.misses += 1
+        else:
+            prof.hits += 1
+        return x
+
+
+##  WalkMemo
+##
+##  Remembers every find1 of another reader during one line, so that
+##  the parsers of the line share their walks of the dictionary.
+##
+class WalkMemo(TrieLookup):
+
+    def __init__(self, tcdb):
+        self.tcdb = tcdb
+        self.memo = {}
+        return
+
+    def find1(self, k, parent=0L):
+        key = (k, parent)
+        try:
+            return self.memo[key]
+        except KeyError:
+            x = self.memo[key] = self.tcdb.find1(k, parent)
+            return x
+
+
+##  Profiler
+##
+##  Counters for the dictionary and the time spent in each parser.
+##  Install it with Translator.set_profiler() (which also hooks the
+##  dictionary) or with set_profiler() of a reader.
+##
+class Profiler(object):
+
+    def __init__(self):
+        self.layers = []
+        self.reset()
+        return
+
+    def reset(self):
+        self.lookups = 0
+        self.hits = 0
+        self.misses = 0
+        self.filtered = 0
+        self.probes = 0
+        self.nbytes = 0
+        self.times = {}
+        for prof in self.layers:
+            prof.reset()
+        return
+
+    def add_time(self, name, dt):
+        self.times[name] = self.times.get(name, 0.0)+dt
+        return
+
+    def report(self, title=None):
+        lines = []
+        if title is not None:
+            lines.append('profile: %s' % title)
+        lines.append('  lookups=%d, hits=%d, misses=%d, filtered=%d' %
+                     (self.lookups, self.hits, self.misses, self.filtered))
+        # the probes of a LayeredTCDB are those of its layers.
+        probes = self.probes+sum( prof.probes for prof in self.layers )
+        nbytes = self.nbytes+sum( prof.nbytes for prof in self.layers )
+        lines.append('  probes=%d (%.2f/lookup), bytes=%d' %
+                     (probes, probes/float(max(1, self.lookups)), nbytes))
+        for (i, prof) in enumerate(self.layers):
+            lines.append('  layer %d: lookups=%d, hits=%d, misses=%d, filtered=%d, probes=%d' %
+                         (i, prof.lookups, prof.hits, prof.misses, prof.filtered, prof.probes))
+        for (name, dt) in sorted(self.times.iteritems()):
+            lines.append('  %-9s %.3f sec' % (name, dt))
+        return '\n'.join(lines)
+
+
+##  TimedParser
+##
+##  Forwards to a parser and adds the time of its get_* calls.
+##
+class TimedParser(object):
+
+    def __init__(self, parser, name, profiler):
+        self.parser = parser
+        self.name = name
+        self.profiler = profiler
+        return
+
+    def __getattr__(self, attr):
+        func = getattr(self.parser, attr)
+        if not attr.startswith('get_'): return func
+        def timed(*args):
+            t0 = time.time()
+            try:
+                return func(*args)
+            finally:
+                self.profiler.add_time(self.name, time.time()-t0)
+        return timed
 
 
 ##  Wakacher
 ##
 class Wakacher(object):
 
-    KIND = {}
-    for (c,k) in (
+    KINDMAP = KindMap([
         (u'AZ', 1), # latin
         (u'az', 1),
         (u'', 1),
@@ -202,13 +915,9 @@ class Wakacher(object):
         (u'09', 5), # digit
         (u'..', 5),
         (u'', 5),
-        ):
-        for i in xrange(ord(c[0]),ord(c[1])+1):
-            KIND[unichr(i)] = k
-    for c in u'"([ҡԡ֡ءڡ̡ȡʡ\uff62':
-        KIND[c] = 6
-    #for c in u')]ӡաס١ۡ͡\uff63':
-    #    KIND[c] = 7
+        ]+[ (c, 6) for c in u'"([ҡԡ֡ءڡ̡ȡʡ\uff62' ])
+    #    +[ (c, 7) for c in u')]ӡաס١ۡ͡\uff63' ]
+    LATINRUN = re.compile(u'[\x01\x05]+')
 
     PREFIX1 = set(
         [u''
@@ -224,6 +933,9 @@ class Wakacher(object):
         u'': u'򤬤ϤǤˤ',
         }
 
+    # hiragana that need a look by _parse_tail.
+    TAILSTOP = re.compile(u'[%s]' % u''.join(sorted(PREFIX1)+sorted(POST1)))
+
     ADV1 = set(
         [u'Ƴ', u'', u'', u'', u'', u'', u'­', u'',
          u'Χ', u'Ƽ', u'䡹', u'', u'´', u'', u'', u'',
@@ -257,19 +969,38 @@ class Wakacher(object):
         return
 
     def feed(self, chars):
+        self._chars = chars
+        self._kinds = kinds = classify(chars, self.KINDMAP)
         i = 0
         while 0 <= i and i < len(chars):
-            c = chars[i]
-            k = self.KIND.get(c, 0)
-            i = self._parse(c, k, i)
+            i = self._parse(chars[i], ord(kinds[i]), i)
         return
 
     def get_chunks(self, chars):
-        self.reset()
-        self.feed(chars)
-        self._flush()
-        (r, self._chunks) = (self._chunks, [])
-        return r
+        p = clone(self)
+        p.reset()
+        p.feed(chars)
+        p._flush()
+        return p._chunks
+
+    # same as get_chunks, but yields each chunk as soon as it is cut.
+    def iter_chunks(self, chars):
+        p = clone(self)
+        p.reset()
+        p._chars = chars
+        p._kinds = kinds = classify(chars, p.KINDMAP)
+        chunks = p._chunks
+        i = 0
+        while 0 <= i and i < len(chars):
+            i = p._parse(chars[i], ord(kinds[i]), i)
+            if chunks:
+                for s in chunks:
+                    yield s
+                del chunks[:]
+        p._flush()
+        for s in chunks:
+            yield s
+        return
     
     def _flush(self):
         if self._chunk:
@@ -285,7 +1016,6 @@ class Wakacher(object):
         elif k == 3:
             self._parse = self._parse_kata
         elif k == 4:
-            self._dstate = 0
             self._parse = self._parse_kanji
         elif k == 5:
             self._parse = self._parse_digit
@@ -297,14 +1027,22 @@ class Wakacher(object):
 
     def _parse_other(self, c, k, i):
         if k == 0:
-            self._chunk += c
-            return i+1
+            j = KINDRUN[0].match(self._kinds, i).end()
+            self._chunk += self._chars[i:j]
+            return j
         self._flush()
         self._parse = self._parse_main
         return i
 
     def _parse_tail(self, c, k, i):
         if k == 2:
+            # Ҥ餬ʤ¤ӤϵˤʤʸμޤǤޤȤƼ롣
+            j = KINDRUN[2].match(self._kinds, i).end()
+            m = self.TAILSTOP.search(self._chars, i, j)
+            e = m.start() if m else j
+            if i < e:
+                self._chunk += self._chars[i:e]
+                return e
             # ֤ꤤפʤɤΡ֤פľڤ롣
             if c in self.PREFIX1:
                 self._prechunk = c
@@ -334,7 +1072,6 @@ class Wakacher(object):
             # ֤+פϡ֤פڤ롣
             self._flush()
             self._chunk += self._prechunk
-            self._dstate = 0
             self._parse = self._parse_kanji
             return i
         self._chunk += self._prechunk
@@ -343,44 +1080,53 @@ class Wakacher(object):
 
     def _parse_latin(self, c, k, i):
         if k == 1 or k == 5:
-            self._chunk += c
-            return i+1
+            j = self.LATINRUN.match(self._kinds, i).end()
+            self._chunk += self._chars[i:j]
+            return j
         self._parse = self._parse_tail
         return i
 
     def _parse_kata(self, c, k, i):
         if k == 3:
-            self._chunk += c
-            return i+1
+            j = KINDRUN[3].match(self._kinds, i).end()
+            self._chunk += self._chars[i:j]
+            return j
         self._parse = self._parse_tail
         return i
         
     def _parse_kanji(self, c, k, i):
         if k == 4:
-            try:
-                (_, self._dstate) = self._tcdb.lookup1(c, self._dstate)
-            except KeyError:
-                self._dstate = 0
+            # ¤Ӥ򼭽ǰȤޤǤޤȤƼ롣
+            chars = self._chars
+            j = KINDRUN[4].match(self._kinds, i).end()
+            while i < j:
+                r = self._tcdb.prefixes(chars, i, j)
+                e = r[-1][0] if r else i
+                self._chunk += chars[i:e]
+                if e == j: break
                 # MAXCONTKANJI ʸʾδñΤȤڤ롣
                 if self.MAXCONTKANJI <= len(self._chunk):
                     self._parse = self._parse_other
-                    return i
-            self._chunk += c
-            return i+1
+                    return e
+                self._chunk += chars[e]
+                i = e+1
+            return j
         self._parse = self._parse_tail
         return i
     
     def _parse_digit(self, c, k, i):
         if k == 5:
-            self._chunk += c
-            return i+1
+            j = KINDRUN[5].match(self._kinds, i).end()
+            self._chunk += self._chars[i:j]
+            return j
         self._parse = self._parse_main
         return i
 
     def _parse_paren(self, c, k, i):
         if k == 6:
-            self._chunk += c
-            return i+1
+            j = KINDRUN[6].match(self._kinds, i).end()
+            self._chunk += self._chars[i:j]
+            return j
         self._parse = self._parse_main
         return i
 
@@ -398,13 +1144,11 @@ class Yomer(object):
         u'': u'',
         }
 
-    KIND = {}
-    for (c,k) in (
+    KINDMAP = KindMap([
         (u'09', 5), # digit
         (u'', 5),
-        ):
-        for i in xrange(ord(c[0]),ord(c[1])+1):
-            KIND[unichr(i)] = k
+        ])
+    OTHERRUN = re.compile(u'[^\x05]+')
             
     def __init__(self, tcdb):
         self._tcdb = tcdb
@@ -420,20 +1164,30 @@ class Yomer(object):
         return
 
     def feed(self, chars):
+        self._chars = chars
+        self._kinds = kinds = classify(chars, self.KINDMAP)
         i = 0
         while 0 <= i and i < len(chars):
-            c = chars[i]
-            k = self.KIND.get(c, 0)
-            i = self._parse(c, k, i)
+            i = self._parse(chars[i], ord(kinds[i]), i)
         return
 
     def get_yomi(self, chars):
-        self.reset()
-        self.feed(chars)
-        self._flush()
+        return [self._segments(chars)]
+
+    # returns the reading of get_yomi as one string.
+    def get_reading(self, chars):
+        return u''.join( y for (_,y) in self._segments(chars) )
+
+    # returns [(text, reading), ...], where the text is either a
+    # reading from the dictionary or a run of characters without one.
+    def _segments(self, chars):
+        p = clone(self)
+        p.reset()
+        p.feed(chars)
+        p._flush()
         x = u''
         a = []
-        for (c,y) in self._chunks:
+        for (c,y) in p._chunks:
             if y is None:
                 x += c
             else:
@@ -443,7 +1197,7 @@ class Yomer(object):
                 a.append((y, reg_yomi(y)))
         if x:
             a.append((x, reg_yomi(x)))
-        return [a]
+        return a
 
     def _flush(self):
         if self._yomi is not None:
@@ -467,8 +1221,9 @@ class Yomer(object):
         if k != 5:
             self._parse = self._parse_unit
             return i
-        self._chunks.append((c, None))
-        return i+1
+        j = KINDRUN[5].match(self._kinds, i).end()
+        self._chunks.extend( (c, None) for c in self._chars[i:j] )
+        return j
     
     def _parse_unit(self, c, k, i):
         if c in self.UNIT:
@@ -482,15 +1237,27 @@ class Yomer(object):
         if k == 5:
             self._parse = self._parse_main
             return i
-        self._part += c
-        try:
-            (v, self._dstate) = self._tcdb.lookup1(c, self._dstate)
-            if v:
-                self._yomi = (len(self._part), v)
-        except KeyError:
+        chars = self._chars
+        j = self.OTHERRUN.match(self._kinds, i).end()
+        while i < j:
+            n = len(self._part)-i
+            r = self._tcdb.prefixes(chars, i, j, self._dstate)
+            for (e,v,p) in r:
+                if v:
+                    self._yomi = (n+e, v)
+            if r:
+                (e,_,self._dstate) = r[-1]
+            else:
+                e = i
+            if e == j:
+                self._part += chars[i:j]
+                break
+            # ˤʤʸ褿ڤ롣
+            self._part += chars[i:e+1]
             self._dstate = 0
             self._flush()
-        return i+1
+            i = e+1
+        return j
 
 
 ##  Tenjer
@@ -604,8 +1371,7 @@ class Tenjer(object):
         for c in s:
             TABLE[c] = b
     
-    KIND = {}
-    for (c,k) in (
+    KINDMAP = KindMap([
         (u'AZ', 1), # latin
         (u'az', 1),
         (u',.', 1),
@@ -614,26 +1380,34 @@ class Tenjer(object):
         (u'', 3), # kata
         (u'09', 5), # digit
         (u'..', 5),
-        ):
-        for i in xrange(ord(c[0]),ord(c[1])+1):
-            KIND[unichr(i)] = k
-    for c in (u'!?"([ҡԡ֡ءڡ̡ȡʡ\uff62'
-              u')]ӡաס١ۡ͡ˡ\uff63'):
-        KIND[c] = 3
+        ]+[ (c, 3) for c in (u'!?"([ҡԡ֡ءڡ̡ȡʡ\uff62'
+                             u')]ӡաס١ۡ͡ˡ\uff63') ])
+
+    # the longest-match tokenizer for a run of kana.
+    # TABLE keys are at most two characters long, so the pairs are
+    # grouped by their first character and anything else is one char.
+    # (compiled on first use)
+    @lazyattr
+    def KATATOKEN(cls):
+        pairs = {}
+        for s in cls.TABLE:
+            if len(s) == 2:
+                pairs.setdefault(s[0], []).append(s[1])
+        return re.compile(u'|'.join(
+            re.escape(c0)+u'['+u''.join( re.escape(c1) for c1 in sorted(cs) )+u']'
+            for (c0,cs) in sorted(pairs.iteritems()) )+u'|.', re.S)
     
     def get_brl(self, chars):
+        p = clone(self)
         i = 0
         chars = zen2han(chars).upper()
-        self._brl = []
-        self._parse = self._parse_main
-        self._part = None
+        p._chars = chars
+        p._kinds = kinds = classify(chars, p.KINDMAP)
+        p._brl = []
+        p._parse = p._parse_main
         while 0 <= i and i < len(chars):
-            c = chars[i]
-            k = self.KIND.get(c, 0)
-            i = self._parse(c, k, i)
-        if self._part is not None:
-            self._brl.append((self._part, self.TABLE.get(self._part)))
-        return self._brl
+            i = p._parse(chars[i], ord(kinds[i]), i)
+        return p._brl
 
     def _parse_main(self, c, k, i):
         if k == 1:
@@ -641,9 +1415,11 @@ class Tenjer(object):
             self._parse = self._parse_latin
             return i
         elif k == 3:
-            self._part = u''
-            self._parse = self._parse_kata
-            return i
+            j = KINDRUN[3].match(self._kinds, i).end()
+            table = self.TABLE
+            self._brl.extend( (s, table.get(s)) for s in
+                              self.KATATOKEN.findall(self._chars, i, j) )
+            return j
         elif k == 5:
             self._brl.append((None, '#'))
             self._parse = self._parse_digit
@@ -653,26 +1429,15 @@ class Tenjer(object):
 
     def _parse_latin(self, c, k, i):
         if k == 1:
-            self._brl.append((c, self.TABLE.get(c)))
-            return i+1
+            j = KINDRUN[1].match(self._kinds, i).end()
+            table = self.TABLE
+            self._brl.extend( (c, table.get(c)) for c in self._chars[i:j] )
+            return j
         elif k == 3 or k == 5:
             self._brl.append((None, ' '))
         self._parse = self._parse_main
         return i
 
-    def _parse_kata(self, c, k, i):
-        if k == 3:
-            if (self._part+c) in self.TABLE:
-                self._part += c
-                return i+1
-            self._brl.append((self._part, self.TABLE.get(self._part)))
-            self._part = c
-            return i+1
-        self._brl.append((self._part, self.TABLE.get(self._part)))
-        self._part = None
-        self._parse = self._parse_main
-        return i
-
     def _parse_digit(self, c, k, i):
         if c == '.':
             self._brl.append((c, '1'))
@@ -700,47 +1465,718 @@ def fold(words, width=40, sep=u' '):
         yield sep.join(r)
     return
 
+
+##  Output
+##
+##  The folded NABCC lines are written out in one of OUTPUTS:
+##  nabcc (as is), unicode (braille patterns U+2800-U+283F) or
+##  brf (NABCC with CRLF and pages). The stages take the lines in
+##  batches (a list per input line) and the writer converts whole
+##  blocks at once with a charmap table.
+##
+def nabcc2unicode():
+    table = range(256)
+    for (b,dots,_) in Tenjer.NABCC:
+        c = 0x2800+sum( 1 << (int(d)-1) for d in dots )
+        table[ord(b)] = c
+        # lowercase NABCC is the same cell.
+        if 0x40 <= ord(b):
+            table[ord(b)+0x20] = c
+    return u''.join(map(unichr, table))
+
+# name: (charmap table, codec, line separator, lines per page)
+OUTPUTS = {
+    'nabcc': (None, None, '\n', 0),
+    'unicode': (nabcc2unicode(), 'utf-8', '\n', 0),
+    'brf': (None, None, '\r\n', 25),
+}
+
+# paginate: lays out batches of lines into pages of pagelines lines.
+# The first line of each page has the page number (in braille
+# digits) at the right margin, and a new page starts with a form feed.
+def paginate(batches, pagelines=25, width=32):
+    if pagelines < 2: raise ValueError('pagelines must be at least 2: %d' % pagelines)
+    page = 0
+    n = 0
+    for lines in batches:
+        if 0 < n and n+len(lines) < pagelines:
+            # the batch fits in the current page.
+            n += len(lines)
+            yield lines
+            continue
+        out = []
+        i = 0
+        while i < len(lines):
+            if n == 0:
+                page += 1
+                num = u'#'+u''.join( Tenjer.TABLE[c] for c in str(page) )
+                head = u' '*(width-len(num))+num
+                if 1 < page:
+                    head = u'\f'+head
+                out.append(head)
+                n = 1
+            j = min(len(lines), i+pagelines-n)
+            out.extend(lines[i:j])
+            n = (n+j-i) % pagelines
+            i = j
+        yield out
+    return
+
+# OutputWriter: encodes batches of lines into fp in blocks
+# of at least bufsize lines.
+class OutputWriter(object):
+
+    def __init__(self, fp, output='nabcc', codec='utf-8', bufsize=4096):
+        (self.table, codec1, self.newline, self.pagelines) = OUTPUTS[output]
+        self.codec = codec1 or codec
+        self.bufsize = bufsize
+        self._fp = fp
+        self._buf = []
+        return
+
+    def __repr__(self):
+        return '<OutputWriter: %r>' % self._fp
+
+    def write(self, lines):
+        self._buf.extend(lines)
+        if self.bufsize <= len(self._buf):
+            self.flush()
+        return
+
+    def flush(self):
+        if self._buf:
+            s = u'\n'.join(self._buf)+u'\n'
+            if self.table is not None:
+                s = codecs.charmap_decode(s.encode('latin-1', 'replace'), 'strict', self.table)[0]
+            s = s.encode(self.codec, 'replace')
+            if self.newline != '\n':
+                s = s.replace('\n', self.newline)
+            self._fp.write(s)
+            self._buf = []
+        self._fp.flush()
+        return
+
+# open_tcdb: a compact trie is recognized by its magic.
+# The overlays are consulted before the dictionary in the given order.
+def open_tcdb(dictpath, dictcodec, reader=TCDBReader, filterbits=0, cachesize=0,
+              overlays=()):
+    if is_ttrie(dictpath):
+        reader = TTrieReader
+    tcdb = reader(dictpath, dictcodec)
+    if filterbits and isinstance(tcdb, TCDBReader):
+        tcdb.build_filter(filterbits)
+    if overlays:
+        tcdb = LayeredTCDB([ open_overlay(path, dictcodec) for path in overlays ]+[tcdb])
+    if cachesize:
+        tcdb = CachedTCDB(tcdb, cachesize)
+    return tcdb
+
+# open_overlay: an overlay is a ttrie, a *.tcdb or a text file.
+def open_overlay(path, dictcodec):
+    if is_ttrie(path):
+        return TTrieReader(path, dictcodec)
+    elif path.endswith('.tcdb'):
+        return MmapTCDBReader(path, dictcodec)
+    else:
+        return TextTrie(path, dictcodec)
+
+
+##  Translator
+##
+class Translator(object):
+
+    def __init__(self, tcdb, width=32, debug=0, chunkcache=0):
+        self.tcdb = tcdb
+        self.width = width
+        self.debug = debug
+        self.tenjer = Tenjer()
+        self.yomer = Yomer(tcdb)
+        self.wakacher = Wakacher(tcdb)
+        self.cache = None
+        if chunkcache:
+            self.cache = LRUCache(chunkcache)
+        return
+
+    def __repr__(self):
+        return '<Translator: %r>' % self.tcdb
+
+    def set_profiler(self, profiler):
+        if hasattr(self.tcdb, 'set_profiler'):
+            self.tcdb.set_profiler(profiler)
+        for name in ('wakacher', 'yomer', 'tenjer'):
+            parser = getattr(self, name)
+            if isinstance(parser, TimedParser):
+                parser = parser.parser
+            if profiler is not None:
+                parser = TimedParser(parser, name, profiler)
+            setattr(self, name, parser)
+        return
+
+    # returns the output lines for one input line.
+    def translate(self, line):
+        out = []
+        r = []
+        cache = self.cache
+        for s in self.wakacher.get_chunks(line):
+            if cache is None:
+                brl = self.translate_chunk(s)
+            else:
+                brl = cache.get(s)
+                if brl is None:
+                    brl = self.translate_chunk(s)
+                    cache.put(s, brl)
+            for (a,b) in brl:
+                if self.debug:
+                    out.append(u'> '+a)
+                r.append(b)
+        out.extend(fold(r, width=self.width))
+        return out
+
+    # returns [(reading, braille), ...] for one chunk.
+    def translate_chunk(self, s):
+        brl = []
+        for y in self.yomer.get_yomi(s):
+            t = u''.join( v or k for (k,v) in y)
+            a = u''
+            b = u''
+            for (x,y) in self.tenjer.get_brl(t):
+                a += x or u''
+                b += y or u''
+            brl.append((a,b))
+        return brl
+
+
+##  FusedTranslator
+##
+##  Same output as Translator, but each chunk is read and brailled
+##  as soon as Wakacher cuts it, in one pass over the line, and the
+##  dictionary walks of the line are shared between the parsers.
+##
+class FusedTranslator(Translator):
+
+    profiler = None
+
+    # the stages are interleaved, so only whole lines are timed.
+    def set_profiler(self, profiler):
+        if hasattr(self.tcdb, 'set_profiler'):
+            self.tcdb.set_profiler(profiler)
+        self.profiler = profiler
+        return
+
+    def translate(self, line):
+        t0 = time.time()
+        wakacher = self.wakacher
+        yomer = self.yomer
+        # sharing the walks only pays off when find1 is not
+        # already a dict lookup.
+        if not getattr(self.tcdb, 'inmemory', False):
+            walks = WalkMemo(self.tcdb)
+            wakacher = clone(wakacher)
+            wakacher._tcdb = walks
+            yomer = clone(yomer)
+            yomer._tcdb = walks
+        out = []
+        r = []
+        cache = self.cache
+        for s in wakacher.iter_chunks(line):
+            brl = None
+            if cache is not None:
+                brl = cache.get(s)
+            if brl is None:
+                brl = self._translate_chunk(yomer, s)
+                if cache is not None:
+                    cache.put(s, brl)
+            (a,b) = brl
+            if self.debug:
+                out.append(u'> '+a)
+            r.append(b)
+        out.extend(fold(r, width=self.width))
+        if self.profiler is not None:
+            self.profiler.add_time('fused', time.time()-t0)
+        return out
+
+    def translate_chunk(self, s):
+        return [self._translate_chunk(self.yomer, s)]
+
+    def _translate_chunk(self, yomer, s):
+        a = u''
+        b = u''
+        for (x,y) in self.tenjer.get_brl(yomer.get_reading(s)):
+            a += x or u''
+            b += y or u''
+        return (a,b)
+
+ENGINES = {
+    'pipeline': Translator,
+    'fused': FusedTranslator,
+    }
+
+
+# process pool workers (each one opens its own dictionary).
+_translator = None
+def _pool_init(dictargs, kwargs, engine=Translator):
+    global _translator
+    _translator = engine(open_tcdb(*dictargs), **kwargs)
+    return
+def _pool_translate(line):
+    return _translator.translate(line)
+def _pool_translate_batch(lines):
+    try:
+        out = []
+        for line in lines:
+            out.extend(_translator.translate(line))
+        return (True, out)
+    except Exception, e:
+        return (False, e)
+
+# translate_parallel
+def translate_parallel(lines, dictargs, nprocs=2, chunksize=64, engine=Translator,
+                       **kwargs):
+    from multiprocessing import Pool
+    pool = Pool(nprocs, _pool_init, (dictargs, kwargs, engine))
+    try:
+        for out in pool.imap(_pool_translate, lines, chunksize):
+            yield out
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    pool.join()
+    return
+
+
+##  AsyncTranslator
+##
+##  Non-blocking front end for event loops: the work is done by a
+##  process pool in batches of chunksize lines, and the output lines
+##  of each batch are passed to a callback in order as they are done
+##  (called from a worker thread, so hand it over to the loop with
+##  e.g. reactor.callFromThread or IOLoop.add_callback).
+##  At most maxpending requests are in flight at a time, and each one
+##  has at most window batches in the pool. The input of a request is
+##  read by its own feeder thread only as fast as it is translated.
+##
+class AsyncTranslator(object):
+
+    def __init__(self, dictargs, nprocs=1, chunksize=64, maxpending=4, window=None,
+                 engine=Translator, **kwargs):
+        from multiprocessing import Pool
+        self.chunksize = chunksize
+        self.window = window or max(1, nprocs)
+        self._slots = threading.Semaphore(maxpending)
+        self._pool = Pool(nprocs, _pool_init, (dictargs, kwargs, engine))
+        return
+
+    def __repr__(self):
+        return '<AsyncTranslator: %r>' % self._pool
+
+    # submits a text or an iterable of lines. Returns False without
+    # waiting if too many requests are pending (unless block is True).
+    # callback(lines) is called for each batch, then done() once at the
+    # end. On an error (in the input, the translation or a callback),
+    # errback(e) is called instead and the rest of the request is dropped.
+    def submit(self, lines, callback, errback=None, done=None, block=False):
+        if isinstance(lines, basestring):
+            lines = re.findall(ur'[^\n]*\n|[^\n]+', lines)
+        if not self._slots.acquire(block): return False
+        try:
+            feeder = threading.Thread(target=self._feed,
+                                      args=(iter(lines), callback, errback, done))
+            feeder.daemon = True
+            feeder.start()
+        except:
+            self._slots.release()
+            raise
+        return True
+
+    # _feed: runs on the feeder thread of a request. The pool's result
+    # thread only hands the results back, it never reads the input.
+    def _feed(self, lines, callback, errback, done):
+        cond = threading.Condition()
+        # [batches sent, batches delivered, failed]
+        state = [0, 0, False]
+        results = {}
+        def fail(e):
+            state[2] = True
+            if errback is not None:
+                try:
+                    errback(e)
+                except Exception:
+                    pass
+            return
+        def arrived(i, result):
+            with cond:
+                results[i] = result
+                while state[1] in results:
+                    (ok, x) = results.pop(state[1])
+                    state[1] += 1
+                    if state[2]:
+                        continue
+                    if not ok:
+                        fail(x)
+                        continue
+                    try:
+                        callback(x)
+                    except Exception, e:
+                        fail(e)
+                cond.notify()
+            return
+        try:
+            try:
+                while 1:
+                    with cond:
+                        while not state[2] and self.window <= state[0]-state[1]:
+                            cond.wait()
+                        if state[2]: break
+                    batch = list(islice(lines, self.chunksize))
+                    if not batch: break
+                    i = state[0]
+                    self._pool.apply_async(_pool_translate_batch, (batch,),
+                                           callback=(lambda r, i=i: arrived(i, r)))
+                    with cond:
+                        state[0] += 1
+            except Exception, e:
+                with cond:
+                    fail(e)
+            # wait until every batch in the pool is delivered.
+            with cond:
+                while state[0] != state[1]:
+                    cond.wait()
+            if done is not None and not state[2]:
+                try:
+                    done()
+                except Exception, e:
+                    fail(e)
+        finally:
+            self._slots.release()
+        return
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        return
+
+
+# socket protocol: each message is a 4-byte big-endian length
+# followed by that many bytes. A request carries input lines in
+# the server's input codec and the reply is UTF-8 text.
+# Frames longer than MAXFRAME are refused.
+MAXFRAME = 1<<24
+def _recvall(sock, n):
+    r = []
+    while n:
+        x = sock.recv(n)
+        if not x: raise EOFError
+        r.append(x)
+        n -= len(x)
+    return ''.join(r)
+def recv_message(sock):
+    (n,) = unpack('>I', _recvall(sock, 4))
+    if MAXFRAME < n: raise ValueError('frame too long: %d' % n)
+    return _recvall(sock, n)
+def send_message(sock, s):
+    sock.sendall(pack('>I', len(s))+s)
+    return
+
+# serve: answers translation requests on a Unix socket.
+# The translator is set up before forking so that the workers
+# share the loaded dictionary and tables copy-on-write.
+def serve(path, translator, nprocs=1, codec='utf-8'):
+    import socket, signal, stat
+    # only a stale socket is replaced, never another kind of file.
+    if os.path.lexists(path):
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise IOError('not a socket: %r' % path)
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(128)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                _serve_forever(sock, translator, codec)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+        return
+    pids = []
+    try:
+        for _ in xrange(max(1, nprocs)):
+            spawn()
+        # a worker that dies is replaced so the server keeps running.
+        while 1:
+            (pid, _) = os.wait()
+            if pid in pids:
+                pids.remove(pid)
+                spawn()
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        sock.close()
+        os.unlink(path)
+    return
+
+def _serve_forever(sock, translator, codec):
+    while 1:
+        (conn, _) = sock.accept()
+        try:
+            while 1:
+                try:
+                    data = recv_message(conn)
+                except EOFError:
+                    break
+                out = []
+                # split and decode each line as fileinput does.
+                for line in re.findall(r'[^\n]*\n|[^\n]+', data):
+                    out.extend(translator.translate(line.decode(codec, 'ignore')))
+                send_message(conn, u'\n'.join(out).encode('utf-8'))
+        except Exception:
+            # a bad request only drops its own connection.
+            pass
+        finally:
+            conn.close()
+    return
+
+# client: sends raw input lines to a server in batches.
+def client(path, lines, bufsize=65536):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    def request(batch):
+        send_message(sock, ''.join(batch))
+        return recv_message(sock).decode('utf-8').split(u'\n')
+    try:
+        batch = []
+        n = 0
+        for line in lines:
+            batch.append(line)
+            n += len(line)
+            if bufsize <= n:
+                for out in request(batch):
+                    yield out
+                batch = []
+                n = 0
+        if batch:
+            for out in request(batch):
+                yield out
+    finally:
+        sock.close()
+    return
+
+
+##  ParagraphCache
+##
+##  Keeps the output lines of each paragraph in a sqlite file, keyed
+##  by a hash of the paragraph and of everything else that affects the
+##  output (the dictionaries, tenjer.py itself and the options), so
+##  that an edited document only has its changed paragraphs translated.
+##
+# paragraphs: groups lines into paragraphs, each ending with a blank line.
+def paragraphs(lines):
+    para = []
+    for line in lines:
+        para.append(line)
+        if not line.strip():
+            yield para
+            para = []
+    if para:
+        yield para
+    return
+
+# cache_ident: the files and options the output depends on.
+def cache_ident(paths, **options):
+    r = []
+    for path in paths+[__file__]:
+        st = os.stat(path)
+        r.append('%s:%d:%d' % (os.path.realpath(path), st.st_size, st.st_mtime))
+    r.extend( '%s=%r' % kv for kv in sorted(options.iteritems()) )
+    return '\n'.join(r)
+
+class ParagraphCache(object):
+
+    def __init__(self, path, ident):
+        import sqlite3
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._ident = hashlib.sha1(ident).digest()
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS paragraphs '
+                         '(key TEXT PRIMARY KEY, lines TEXT)')
+        return
+
+    def __repr__(self):
+        return ('<ParagraphCache: %r, hits=%d, misses=%d>' %
+                (self.path, self.hits, self.misses))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+        return
+
+    # yields the output lines of each paragraph, calling
+    # translate(line) only for the paragraphs not in the cache.
+    def translate(self, paras, translate):
+        db = self._db
+        for para in paras:
+            h = hashlib.sha1(self._ident)
+            h.update(u'\n'.join(para).encode('utf-8'))
+            key = h.hexdigest()
+            row = db.execute('SELECT lines FROM paragraphs WHERE key=?', (key,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                out = row[0].split(u'\n')[:-1]
+            else:
+                self.misses += 1
+                out = [ s for line in para for s in translate(line) ]
+                # each line is terminated so that [] and [u''] differ.
+                db.execute('INSERT OR REPLACE INTO paragraphs VALUES (?,?)',
+                           (key, u''.join( s+u'\n' for s in out )))
+            yield out
+        db.commit()
+        return
+
 # main
 def main(argv):
     import getopt, fileinput
     def usage():
-        print 'usage: %s [-d] [-c codec] [-w width] [-D dictpath] [file ...]' % argv[0]
+        print ('usage: %s [-d] [-P] [-m|-t] [-F bits] [-L cachesize] [-K chunkcache]'
+               ' [-E engine] [-j nprocs] [-c codec] [-w width] [-D dictpath]'
+               ' [-O overlay] [-o output] [-p pagelines] [-R cachefile] [file ...]' % argv[0])
+        print '       %s [options] -S sockpath' % argv[0]
+        print '       %s -s sockpath [file ...]' % argv[0]
         return 100
     try:
-        (opts, args) = getopt.getopt(argv[1:], 'dw:c:C:D:')
+        (opts, args) = getopt.getopt(argv[1:], 'dPmtF:L:K:E:j:w:c:C:D:O:S:s:o:p:R:')
     except getopt.GetoptError:
         return usage()
     debug = 0
+    profile = 0
+    reader = TCDBReader
+    filterbits = 0
+    cachesize = 0
+    chunkcache = 0
+    engine = Translator
+    nprocs = 0
+    server = None
+    connect = None
     width = 32
     codec = 'utf-8'
     dictcodec = 'euc-jp'
     dictpath = os.path.join(os.path.dirname(__file__), 'tenjer.tcdb')
+    overlays = []
+    output = 'nabcc'
+    pagelines = None
+    cachefile = None
     for (k, v) in opts:
         if k == '-d': debug += 1
+        elif k == '-P': profile += 1
+        elif k == '-m': reader = MmapTCDBReader
+        elif k == '-t': reader = TCDBTrie
+        elif k == '-F': filterbits = int(v)
+        elif k == '-L': cachesize = int(v)
+        elif k == '-K': chunkcache = int(v)
+        elif k == '-E':
+            if v not in ENGINES: return usage()
+            engine = ENGINES[v]
+        elif k == '-j': nprocs = int(v)
+        elif k == '-S': server = v
+        elif k == '-s': connect = v
         elif k == '-w': width = int(v)
         elif k == '-c': codec = v
         elif k == '-C': dictcodec = v
         elif k == '-D': dictpath = v
-    tcdb = TCDBReader(dictpath, dictcodec)
-    tenjer = Tenjer()
-    yomer = Yomer(tcdb)
-    wakacher = Wakacher(tcdb)
-    for line in fileinput.input(args):
-        line = line.decode(codec, 'ignore')
-        r = []
-        for s in wakacher.get_chunks(line):
-            for y in yomer.get_yomi(s):
-                t = u''.join( v or k for (k,v) in y)
-                a = u''
-                b = u''
-                for (x,y) in tenjer.get_brl(t):
-                    a += x or u''
-                    b += y or u''
-                if debug:
-                    print '>', a
-                r.append(b)
-        for line in fold(r, width=width):
-            print line
+        elif k == '-O': overlays.append(v)
+        elif k == '-o':
+            if v not in OUTPUTS: return usage()
+            output = v
+        elif k == '-p':
+            # a page needs a line besides its number.
+            pagelines = int(v)
+            if pagelines != 0 and pagelines < 2: return usage()
+        elif k == '-R': cachefile = v
+    dictargs = (dictpath, dictcodec, reader, filterbits, cachesize, overlays)
+    if server is not None:
+        # the forked workers must not share a file position.
+        if reader is TCDBReader:
+            dictargs = (dictpath, dictcodec, MmapTCDBReader, filterbits, cachesize,
+                        overlays)
+        translator = engine(open_tcdb(*dictargs), width=width, debug=debug,
+                            chunkcache=chunkcache)
+        try:
+            serve(server, translator, nprocs=nprocs, codec=codec)
+        except IOError, e:
+            print >>sys.stderr, '%s: %s' % (argv[0], e)
+            return 1
+        return 0
+    # the debug lines are not braille, so they are written as they are.
+    if debug:
+        output = 'nabcc'
+        pagelines = 0
+    # an interactive session sees each line as soon as it is done.
+    writer = OutputWriter(sys.stdout, output=output, codec=(sys.stdout.encoding or codec),
+                          bufsize=(0 if sys.stdout.isatty() else 4096))
+    if pagelines is None:
+        pagelines = writer.pagelines
+    def write(batches):
+        if pagelines:
+            batches = paginate(batches, pagelines=pagelines, width=width)
+        for lines in batches:
+            writer.write(lines)
+        writer.flush()
+        return
+    if connect is not None:
+        write( [line] for line in client(connect, fileinput.input(args)) )
+        return 0
+    # the paragraph cache leaves little to be done in parallel.
+    if 1 < nprocs and cachefile is None:
+        lines = ( line.decode(codec, 'ignore') for line in fileinput.input(args) )
+        write(translate_parallel(lines, dictargs, nprocs=nprocs, engine=engine,
+                                 width=width, debug=debug, chunkcache=chunkcache))
+        return 0
+    translator = engine(open_tcdb(*dictargs), width=width, debug=debug,
+                        chunkcache=chunkcache)
+    profiler = None
+    if profile:
+        profiler = Profiler()
+        translator.set_profiler(profiler)
+    fp = fileinput.input(args)
+    def readlines():
+        filename = None
+        for line in fp:
+            # -PP reports each input file separately.
+            if 1 < profile and filename != fp.filename():
+                if filename is not None:
+                    writer.flush()
+                    print >>sys.stderr, profiler.report(filename)
+                    profiler.reset()
+                filename = fp.filename()
+            yield line.decode(codec, 'ignore')
+        return
+    if cachefile is None:
+        write( translator.translate(line) for line in readlines() )
+    else:
+        ident = cache_ident([dictpath]+overlays, width=width, debug=debug,
+                            dictcodec=dictcodec)
+        cache = ParagraphCache(cachefile, ident)
+        try:
+            write(cache.translate(paragraphs(readlines()), translator.translate))
+        finally:
+            cache.close()
+        if debug:
+            print >>sys.stderr, cache
+    if profile:
+        print >>sys.stderr, profiler.report(fp.filename() if 1 < profile else 'total')
+    if cachesize and debug:
+        print >>sys.stderr, translator.tcdb
+    if chunkcache and debug:
+        print >>sys.stderr, translator.cache
     return 0
 
 if __name__ == '__main__': sys.exit(main(sys.argv))